@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the train input pipeline: images/sec of get_train_dataset over
+each of the given directories (png pairs or TFRecord pairs).
+"""
+import argparse
+import logging
+import time
+
+from gan_network.pix2pix_data_pipeline import AUGMENTATIONS, get_train_dataset
+
+
+def images_per_second(
+    data_dir: str,
+    steps: int,
+    batch_size: int,
+    cache: str = None,
+    augmentation: str = "batch",
+    warmup: int = 10,
+):
+    dataset = get_train_dataset(
+        data_dir, batch_size=batch_size, cache=cache, augmentation=augmentation
+    )
+    dataset = dataset.repeat()
+    iterator = iter(dataset)
+    for _ in range(warmup):
+        next(iterator)
+    start = time.perf_counter()
+    for _ in range(steps):
+        next(iterator)
+    return steps * batch_size / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--data_dirs",
+        type=str,
+        nargs="+",
+        help="png pairs and/or TFRecord pairs directories",
+    )
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="cache of the decoded pairs: 'memory' or a local directory",
+    )
+    parser.add_argument(
+        "--augmentations",
+        type=str,
+        nargs="+",
+        choices=AUGMENTATIONS,
+        default=["batch"],
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    for data_dir in args.data_dirs:
+        for augmentation in args.augmentations:
+            rate = images_per_second(
+                data_dir, args.steps, args.batch_size, args.cache, augmentation
+            )
+            print(f"{data_dir} ({augmentation}): {rate:.1f} images/sec")
+
+
+if __name__ == "__main__":
+    main()
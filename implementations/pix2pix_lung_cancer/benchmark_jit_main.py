@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmarks GanModel with and without XLA (--jit of train_main.py and
+production_main.py), for each given precision policy (--precision): train
+steps/sec and generator inference latency, on random images.
+"""
+import argparse
+import logging
+import tempfile
+import time
+
+import tensorflow as tf
+
+from gan_network.gan_model import PRECISIONS, GanModel
+
+
+def benchmark(
+    jit_compile: bool,
+    steps: int,
+    inferences: int,
+    batch_size: int,
+    image_size: int,
+    precision: str = "float32",
+    warmup: int = 3,
+):
+    """
+    Returns the train steps/sec and the mean inference latency (ms).
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model = GanModel(
+            checkpoint_dir=tmp_dir,
+            save_image_dir=tmp_dir,
+            log_dir=tmp_dir,
+            input_size=(image_size, image_size),
+            jit_compile=jit_compile,
+            precision=precision,
+        )
+        shape = (batch_size, image_size, image_size, 3)
+        images = tf.random.uniform(shape, -1.0, 1.0)
+        train_iterator = iter(tf.data.Dataset.from_tensors((images, images)).repeat())
+        # warm up (tracing and compilation)
+        model.train(train_iterator, warmup)
+        start = time.perf_counter()
+        model.train(train_iterator, steps)
+        steps_per_sec = steps / (time.perf_counter() - start)
+
+        for _ in range(warmup):
+            model.generate(images).numpy()
+        start = time.perf_counter()
+        for _ in range(inferences):
+            model.generate(images).numpy()
+        latency_ms = (time.perf_counter() - start) / inferences * 1000
+    return steps_per_sec, latency_ms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=20, help="train steps")
+    parser.add_argument("--inferences", type=int, default=20)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--image_size", type=int, default=256)
+    parser.add_argument(
+        "--precisions",
+        type=str,
+        nargs="+",
+        choices=PRECISIONS,
+        default=["float32"],
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    for precision in args.precisions:
+        for jit_compile in (False, True):
+            steps_per_sec, latency_ms = benchmark(
+                jit_compile,
+                args.steps,
+                args.inferences,
+                args.batch_size,
+                args.image_size,
+                precision,
+            )
+            print(
+                f"{precision} jit={jit_compile}: {steps_per_sec:.2f} train steps/sec, "
+                f"{latency_ms:.1f} ms/inference"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the activation recomputation of the generator (--recompute of
+train_main.py): train steps/sec and peak memory of a train step, with and
+without it, for each given batch size, on random images.
+
+Every setting runs in its own process, so that the memory of the previous
+models does not add up. The peak memory depends on how the ops of a step are
+scheduled on the inter-op threads - run enough steps to catch it.
+"""
+import argparse
+import logging
+import multiprocessing
+import tempfile
+import time
+from typing import Tuple
+
+import tensorflow as tf
+
+from gan_network.gan_model import GanModel
+
+DEVICE = "CPU:0"
+
+
+def benchmark(
+    recompute: bool,
+    steps: int,
+    batch_size: int,
+    image_size: int,
+    warmup: int = 2,
+) -> Tuple[float, float, float]:
+    """
+    Returns the train steps/sec, the peak memory allocated by TensorFlow during
+    the train steps and its part above the memory held between two steps
+    (weights, optimizer slots...) - in MiB.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model = GanModel(
+            checkpoint_dir=tmp_dir,
+            save_image_dir=tmp_dir,
+            log_dir=tmp_dir,
+            input_size=(image_size, image_size),
+            recompute=recompute,
+        )
+        shape = (batch_size, image_size, image_size, 3)
+        images = tf.random.uniform(shape, -1.0, 1.0)
+        train_iterator = iter(tf.data.Dataset.from_tensors((images, images)).repeat())
+        # warm up (tracing, optimizer slots)
+        model.train(train_iterator, warmup)
+        tf.config.experimental.reset_memory_stats(DEVICE)
+        held = tf.config.experimental.get_memory_info(DEVICE)["current"]
+        start = time.perf_counter()
+        model.train(train_iterator, steps)
+        steps_per_sec = steps / (time.perf_counter() - start)
+        peak = tf.config.experimental.get_memory_info(DEVICE)["peak"]
+    return steps_per_sec, peak / 2**20, (peak - held) / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=5, help="train steps")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--image_size", type=int, default=256)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    context = multiprocessing.get_context("spawn")
+    for batch_size in args.batch_sizes:
+        for recompute in (False, True):
+            with context.Pool(1) as pool:
+                steps_per_sec, peak, step_peak = pool.apply(
+                    benchmark, (recompute, args.steps, batch_size, args.image_size)
+                )
+            print(
+                f"batch_size={batch_size} recompute={recompute}: "
+                f"{steps_per_sec:.2f} train steps/sec, {peak:.0f} MiB peak "
+                f"({step_peak:.0f} MiB above the weights and optimizer slots)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Packs the (input, real) training pairs into sharded TFRecord files
+(see gan_network/pair_records.py) - either from the side by side png pairs of
+generate_test_data_main.py, or generated on the fly from the patches.
+"""
+import argparse
+from argparse import Namespace
+import logging
+import os
+from typing import Generator, List, Tuple
+
+import cv2
+import numpy as np
+
+from gan_network.pair_records import (
+    ENCODINGS,
+    SKETCH_ENCODINGS,
+    write_pair_records,
+)
+from gan_network.pix2pix_data_pipeline import streaming_pairs
+from preprocess.patch_store import list_patches
+
+
+def parse_args() -> Namespace:
+    """
+    returns the parsed args
+    """
+    parset = argparse.ArgumentParser()
+    parset.add_argument(
+        "--input_data_dir",
+        type=str,
+        default=None,
+        help="side by side png pairs directory (generate_test_data_main output)",
+    )
+    parset.add_argument(
+        "--patches_dir",
+        type=str,
+        default=None,
+        help="patches directory - generates the pairs on the fly instead",
+    )
+    parset.add_argument(
+        "--rotate_images",
+        type=int,
+        default=90,
+        help="rotation step (in degrees) of the pairs generated from the patches",
+    )
+    parset.add_argument(
+        "--output_dir",
+        type=str,
+        default="./data/saved_input_records",
+        help="records directory",
+    )
+    parset.add_argument(
+        "--num_shards", type=int, default=16, help="number of record files"
+    )
+    parset.add_argument(
+        "--encoding",
+        type=str,
+        choices=ENCODINGS,
+        default="raw",
+        help="real image encoding inside the records - raw decodes faster than "
+        "png (about 1.5x the train images/sec) for about twice the disk space",
+    )
+    parset.add_argument(
+        "--sketch_encoding",
+        type=str,
+        choices=SKETCH_ENCODINGS,
+        default="png",
+        help="sketch encoding inside the records - bits packs the sketch at 1 bit "
+        "per pixel, but thresholds its gray edges at 128 (lossy)",
+    )
+    parset.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the shuffling of the pairs across (and within) the shards",
+    )
+    return parset.parse_args()
+
+
+def shuffled(names: List[str], seed: int) -> List[str]:
+    """
+    Returns the names in a random order - the pairs are written round robin to
+    the shards, so that neighbouring (e.g. same patch) pairs are spread over
+    the shards instead of following each other in the sorted name order.
+    """
+    names = sorted(names)
+    np.random.default_rng(seed).shuffle(names)
+    return names
+
+
+def png_pairs(
+    input_data_dir: str, seed: int = 0
+) -> Generator[Tuple[str, np.ndarray, np.ndarray], None, None]:
+    """
+    Splits the side by side png pairs (input on the left) into RGB images.
+    """
+    files = [file for file in os.listdir(input_data_dir) if file.endswith(".png")]
+    for file in shuffled(files, seed):
+        image = cv2.imread(os.path.join(input_data_dir, file))
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        w = image.shape[1] // 2
+        yield os.path.splitext(file)[0], image[:, :w], image[:, w:]
+
+
+def patch_pairs(
+    patches_dir: str, rotate_images: int, seed: int = 0
+) -> Generator[Tuple[str, np.ndarray, np.ndarray], None, None]:
+    """
+    Generates the pairs of every patch, named like generate_test_data_main.py.
+    """
+    generate = streaming_pairs(patches_dir, rotate_images)
+    for image_name in shuffled(list_patches(patches_dir), seed):
+        for img_i, (input_image, real_image) in enumerate(
+            generate(image_name.encode())
+        ):
+            yield f"{image_name}_{img_i}", input_image, real_image
+
+
+def main():
+    logging.info("Parsing args...")
+    args = parse_args()
+    logging.info("Processing with arguments: %s", str(args))
+    if args.patches_dir is not None:
+        pairs = patch_pairs(args.patches_dir, args.rotate_images, args.seed)
+    else:
+        pairs = png_pairs(args.input_data_dir, args.seed)
+    write_pair_records(
+        pairs, args.output_dir, args.num_shards, args.encoding, args.sketch_encoding
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
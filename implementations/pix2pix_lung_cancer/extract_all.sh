@@ -1,14 +1,13 @@
 #!/bin/bash
 
-# Extract all the files
-echo "Extracting all the files..."
-for i in {0..9}
-do
-    echo "Extracting subset$i..."
-    python ./preprocess/main.py --data_dir ./data/LUNA16/subset$i \
-     --patches_dir ./data/LUNA_patches --annotations_file ./data/LUNA16/annotations.csv \
-      --candidates_file ./data/LUNA16/candidates.csv
-    echo "Done subset$i!"
-done
+# Number of worker processes - each worker holds a full CT volume in memory
+WORKERS=${WORKERS:-4}
 
-echo "Done!"
\ No newline at end of file
+# Extract all the files - series already in the manifest of the patches dir
+# (same files, candidates and parameters) are skipped, so reruns are resumable
+echo "Extracting all the files (workers: $WORKERS)..."
+python ./preprocess/main.py --data_dir ./data/LUNA16/subset{0..9} \
+ --patches_dir ./data/LUNA_patches --annotations_file ./data/LUNA16/annotations.csv \
+  --candidates_file ./data/LUNA16/candidates.csv --workers $WORKERS
+
+echo "Done!"
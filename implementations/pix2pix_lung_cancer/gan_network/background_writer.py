@@ -0,0 +1,74 @@
+"""
+Background writer of the sample images dumped while training (see
+GanModel.fit): the dumps are queued and run by a worker thread - the PNG
+encodes and the file writes of the predicted images - so that the training
+loop does not wait for them.
+
+The queue is bounded: when the writer falls behind, new dumps are skipped
+(with a warning) instead of stalling the training or piling up images.
+"""
+import logging
+import queue
+import threading
+from typing import Any, Callable
+
+import numpy as np
+
+
+def image_grid(images: np.ndarray) -> np.ndarray:
+    """
+    Stacks a batch of images (batch_size, height, width, channels) into a
+    single column image (batch_size * height, width, channels).
+    """
+    return np.concatenate(list(images), axis=0)
+
+
+class BackgroundWriter:
+    """
+    Runs the submitted writes, in order, in a worker thread.
+    """
+
+    def __init__(self, max_queue: int = 2):
+        """
+        :param max_queue: the number of writes waiting at most
+        """
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        # a daemon thread, so that a failed training does not hang on it
+        self._thread = threading.Thread(
+            target=self._run, name="background_writer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, write: Callable[..., Any], *args: Any) -> bool:
+        """
+        Queues write(*args) - skipped when the queue is full.
+        :return: whether the write was queued
+        """
+        try:
+            self._queue.put_nowait((write, args))
+        except queue.Full:
+            logging.warning(
+                "Skipping a background write - %d writes pending",
+                self._queue.maxsize,
+            )
+            return False
+        return True
+
+    def close(self) -> None:
+        """
+        Waits for the queued writes and stops the worker thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            write, args = item
+            try:
+                write(*args)
+            except Exception:
+                # a failed dump must not stop the next ones (or the training)
+                logging.exception("Background write failed")
@@ -1,6 +1,8 @@
 from typing import Any, Tuple
 import tensorflow as tf
 
+from gan_network.distribute import average_loss
+
 
 def downsample(filters: Any, size: Any, apply_batchnorm=True) -> Any:
     initializer = tf.random_normal_initializer(0.0, 0.02)
@@ -22,6 +24,11 @@ def downsample(filters: Any, size: Any, apply_batchnorm=True) -> Any:
 
 
 def Discriminator(input_size: Tuple[int, int] = (256, 256)) -> tf.keras.Model:
+    """
+    70x70 PatchGAN: its depth does not depend on the input size, only the
+    number of classified patches does - 30x30 for 256x256, 14x14 for 128x128.
+    :param input_size: the (height, width) of the images
+    """
     initiliazer = tf.random_normal_initializer(0.0, 0.02)
 
     inp = tf.keras.layers.Input(
@@ -50,16 +57,24 @@ def Discriminator(input_size: Tuple[int, int] = (256, 256)) -> tf.keras.Model:
     last = tf.keras.layers.Conv2D(1, 4, strides=1, kernel_initializer=initiliazer)(
         zero_pad2
     )  # (batch_size, 30, 30, 1)
+    # float32 output (and losses), whatever the compute dtype of the layers
+    last = tf.keras.layers.Activation("linear", dtype="float32")(last)
 
     return tf.keras.Model(inputs=[inp, tar], outputs=last)
 
 
 def discriminator_loss(disc_real_output, disc_generated_output):
-    loss_object = tf.keras.losses.BinaryCrossentropy(from_logits=True)
-    real_loss = loss_object(tf.ones_like(disc_real_output), disc_real_output)
+    loss_object = tf.keras.losses.BinaryCrossentropy(
+        from_logits=True, reduction=tf.keras.losses.Reduction.NONE
+    )
+    disc_real_output = tf.cast(disc_real_output, tf.float32)
+    disc_generated_output = tf.cast(disc_generated_output, tf.float32)
+    real_loss = average_loss(
+        loss_object(tf.ones_like(disc_real_output), disc_real_output)
+    )
 
-    generated_loss = loss_object(
-        tf.zeros_like(disc_generated_output), disc_generated_output
+    generated_loss = average_loss(
+        loss_object(tf.zeros_like(disc_generated_output), disc_generated_output)
     )
 
     total_disc_loss = real_loss + generated_loss
@@ -0,0 +1,108 @@
+"""
+Distribution strategies of the training (see GanModel):
+- "none": the default strategy (a single replica)
+- "mirrored": synchronous data parallel training across the logical CPU
+  devices of a machine (the physical CPU is split in cpu_devices devices)
+- "multi_worker": synchronous data parallel training across worker processes,
+  configured by the TF_CONFIG environment variable (see local_tf_config)
+"""
+import json
+from typing import Any, Dict, Optional
+
+import tensorflow as tf
+
+DISTRIBUTIONS = ["none", "mirrored", "multi_worker"]
+
+
+def split_cpu(cpu_devices: int) -> None:
+    """
+    Splits the physical CPU in cpu_devices logical devices - must be called
+    before TensorFlow initializes its devices.
+    """
+    cpu = tf.config.list_physical_devices("CPU")[0]
+    tf.config.set_logical_device_configuration(
+        cpu, [tf.config.LogicalDeviceConfiguration() for _ in range(cpu_devices)]
+    )
+
+
+def create_strategy(
+    distribution: str = "none", cpu_devices: int = 1
+) -> tf.distribute.Strategy:
+    """
+    Returns the distribution strategy of the training.
+    :param distribution: one of DISTRIBUTIONS
+    :param cpu_devices: the number of logical CPU devices ("mirrored" uses
+        them all, as one replica each)
+    """
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError(f"Unknown distribution: {distribution}")
+    if cpu_devices > 1:
+        split_cpu(cpu_devices)
+    if distribution == "mirrored":
+        devices = [device.name for device in tf.config.list_logical_devices("CPU")]
+        # NCCL (the default all-reduce) needs GPUs
+        return tf.distribute.MirroredStrategy(
+            devices, cross_device_ops=tf.distribute.ReductionToOneDevice()
+        )
+    if distribution == "multi_worker":
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    return tf.distribute.get_strategy()
+
+
+def is_chief(strategy: tf.distribute.Strategy) -> bool:
+    """
+    Whether this process writes the checkpoints, summaries and images - the
+    only process, or the first worker of a multi worker training.
+    """
+    resolver = getattr(strategy, "cluster_resolver", None)
+    if resolver is None or not resolver.task_type:
+        return True
+    return resolver.task_type == "chief" or (
+        resolver.task_type == "worker" and resolver.task_id == 0
+    )
+
+
+def task_id(strategy: tf.distribute.Strategy) -> Optional[int]:
+    resolver = getattr(strategy, "cluster_resolver", None)
+    return None if resolver is None else resolver.task_id
+
+
+def average_loss(losses: tf.Tensor) -> tf.Tensor:
+    """
+    Averages per element losses (batch_size, ...) over the global batch: the
+    mean of a single replica, divided by the number of replicas in sync (the
+    gradients of the replicas are summed).
+    """
+    per_example_losses = tf.reduce_mean(
+        tf.reshape(losses, [tf.shape(losses)[0], -1]), axis=1
+    )
+    return tf.nn.compute_average_loss(per_example_losses)
+
+
+def check_batch_size(
+    strategy: tf.distribute.Strategy, batch_size: int, accumulation_steps: int = 1
+) -> None:
+    """
+    Raises a ValueError when the global batch size does not split evenly
+    between the replicas of the strategy, and then in accumulation_steps
+    micro-batches.
+    """
+    replicas = strategy.num_replicas_in_sync
+    if batch_size % (replicas * accumulation_steps) != 0:
+        raise ValueError(
+            f"The batch size ({batch_size}) must be a multiple of the number of "
+            f"replicas ({replicas}) times the accumulation steps "
+            f"({accumulation_steps})"
+        )
+
+
+def local_tf_config(num_workers: int, index: int, port: int = 12345) -> str:
+    """
+    Returns the TF_CONFIG of the index-th of num_workers local worker
+    processes (to test multi worker training on a single machine).
+    """
+    config: Dict[str, Any] = {
+        "cluster": {"worker": [f"localhost:{port + i}" for i in range(num_workers)]},
+        "task": {"type": "worker", "index": index},
+    }
+    return json.dumps(config)
@@ -2,14 +2,37 @@ import datetime
 import logging
 import os
 import time
-from typing import Tuple
+from typing import Optional, Tuple
 import numpy as np
 import tensorflow as tf
 
+from gan_network.background_writer import BackgroundWriter, image_grid
 from gan_network.discriminator import Discriminator, discriminator_loss
+from gan_network.distribute import is_chief, task_id
 from gan_network.generator import Generator, generator_loss
 
 
+def crossed(previous_step: int, step: int, every: int) -> bool:
+    """
+    Returns whether a multiple of every is in (previous_step, step].
+    """
+    return step // every > previous_step // every
+
+
+def split_batch(batch: tf.Tensor, num_splits: int) -> tf.Tensor:
+    """
+    Splits a batch (batch_size, ...) in num_splits micro-batches
+    (num_splits, batch_size / num_splits, ...) - batch_size must be a multiple
+    of num_splits.
+    """
+    return tf.reshape(batch, tf.concat([[num_splits, -1], tf.shape(batch)[1:]], 0))
+
+
+LOSS_NAMES = ["gen_total_loss", "gen_gan_loss", "gen_l1_loss", "disc_loss"]
+# keras mixed precision policies - variables are always float32
+PRECISIONS = ["float32", "mixed_bfloat16", "mixed_float16"]
+
+
 class GanModel:
     def __init__(
         self,
@@ -18,40 +41,143 @@ class GanModel:
         log_dir: str = "logs/",
         input_size: Tuple[int, int] = (256, 256),
         load_checkpoint: bool = False,
+        max_to_keep: int = 5,
+        async_checkpoint: bool = True,
+        jit_compile: bool = False,
+        precision: str = "float32",
+        strategy: Optional[tf.distribute.Strategy] = None,
+        accumulation_steps: int = 1,
+        recompute: bool = False,
     ):
-        # Using legacy Adam optimizer since running on mac M1
-        self._generator_optimizer = tf.keras.optimizers.legacy.Adam(2e-4, beta_1=0.5)
-        self._discriminator_optimizer = tf.keras.optimizers.legacy.Adam(
-            2e-4, beta_1=0.5
-        )
-        self._generator = Generator()
-        self._discriminator = Discriminator()
+        """
+        :param checkpoint_dir: the checkpoints directory
+        :param save_image_dir: the directory of the images generated while training
+        :param log_dir: the summaries directory
+        :param input_size: the (height, width) of the images - the generator
+            depth derives from it (see generator_depth)
+        :param load_checkpoint: restore the latest checkpoint of checkpoint_dir
+            (weights, optimizers and global step) - starts from scratch when
+            there is none
+        :param max_to_keep: the number of checkpoints kept (older ones are deleted)
+        :param async_checkpoint: write the checkpoints in the background, so that
+            training is not stalled on disk writes - not when fit saves the
+            train iterator (the background saves leave it out)
+        :param jit_compile: compile the train step and the generator forward
+            pass with XLA
+        :param precision: one of PRECISIONS - the compute dtype of the
+            generator and discriminator layers (their outputs and the losses
+            stay float32). mixed_float16 also scales the losses of both
+            optimizers, so that small float16 gradients do not underflow
+        :param strategy: the tf.distribute strategy (see gan_network/distribute.py)
+            the models, optimizers and train steps are replicated with - None
+            for a single replica. Only the chief (the first worker) writes the
+            summaries and images, and checkpoints in checkpoint_dir
+        :param accumulation_steps: the number of micro-batches every (replica)
+            batch is split in - their gradients are summed before a single
+            update of the optimizers, so that only the activations of a
+            micro-batch are in memory at a time. The batch size must be a
+            multiple of it. BatchNormalization still normalizes with the
+            statistics of a micro-batch (not of the whole batch), and its
+            moving averages are updated once per micro-batch
+        :param recompute: recompute the activations of the generator blocks in
+            the backward pass instead of keeping them (see Generator) - a
+            bigger batch fits in the same memory, for a slower step
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision: {precision}")
+        if accumulation_steps < 1:
+            raise ValueError(f"Invalid accumulation steps: {accumulation_steps}")
+        self._accumulation_steps = accumulation_steps
+        self._strategy = strategy or tf.distribute.get_strategy()
+        self._distributed = strategy is not None
+        self._chief = is_chief(self._strategy)
+        with self._strategy.scope():
+            # Using legacy Adam optimizer since running on mac M1
+            self._generator_optimizer = tf.keras.optimizers.legacy.Adam(
+                2e-4, beta_1=0.5
+            )
+            self._discriminator_optimizer = tf.keras.optimizers.legacy.Adam(
+                2e-4, beta_1=0.5
+            )
+            self._loss_scaling = precision == "mixed_float16"
+            if self._loss_scaling:
+                self._generator_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(
+                    self._generator_optimizer
+                )
+                self._discriminator_optimizer = (
+                    tf.keras.mixed_precision.LossScaleOptimizer(
+                        self._discriminator_optimizer
+                    )
+                )
+            # the layers take their dtype policy from the global one when created
+            global_policy = tf.keras.mixed_precision.global_policy()
+            tf.keras.mixed_precision.set_global_policy(precision)
+            try:
+                self._generator = Generator(input_size, recompute=recompute)
+                self._discriminator = Discriminator(input_size)
+            finally:
+                tf.keras.mixed_precision.set_global_policy(global_policy)
+            self._generator.build((None, *input_size, 3))
+            self._discriminator.build((None, *input_size, 3))
+            # the losses, averaged on device between two summaries
+            self._loss_metrics = {
+                name: tf.keras.metrics.Mean(name) for name in LOSS_NAMES
+            }
+            # the number of train steps done - saved with the model
+            self._step = tf.Variable(0, dtype=tf.int64, trainable=False, name="step")
         self._log_dir = log_dir
         self._save_image_dir = save_image_dir
-        self._summary_writer = tf.summary.create_file_writer(
-            log_dir + "/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-        )
-        self._checkpoint_prefix = os.path.join(checkpoint_dir, "ckpt")
+        if self._chief:
+            # events are queued and flushed by the writer in the background
+            self._summary_writer = tf.summary.create_file_writer(
+                log_dir + "/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+                max_queue=100,
+                flush_millis=30000,
+            )
+        else:
+            self._summary_writer = tf.summary.create_noop_writer()
         self._checkpoint = tf.train.Checkpoint(
             generator_optimizer=self._generator_optimizer,
             discriminator_optimizer=self._discriminator_optimizer,
             generator=self._generator,
             discriminator=self._discriminator,
+            step=self._step,
+        )
+        # every worker has to save (the variables are gathered collectively),
+        # the other workers save to their own directory (emptied after each save)
+        self._checkpoint_manager = tf.train.CheckpointManager(
+            self._checkpoint,
+            (
+                checkpoint_dir
+                if self._chief
+                else os.path.join(
+                    checkpoint_dir, "workers", f"worker_{task_id(self._strategy)}"
+                )
+            ),
+            max_to_keep=max_to_keep if self._chief else 1,
+            checkpoint_name="ckpt",
+            step_counter=self._step,
         )
-        self._generator.build((None, *input_size, 3))
-        self._discriminator.build((None, *input_size, 3))
+        if async_checkpoint and self._loss_scaling:
+            # async checkpoints skip the LossScaleOptimizer (and its state)
+            logging.warning("Synchronous checkpoints with mixed_float16")
+            async_checkpoint = False
+        self._checkpoint_options = tf.train.CheckpointOptions(
+            enable_async=async_checkpoint
+        )
+        self._compiled_train_step = tf.function(
+            self._train_step, jit_compile=jit_compile
+        )
+        self._compiled_generate = tf.function(self._generate, jit_compile=jit_compile)
         if load_checkpoint:
-            logging.info("Loading checkpoint...: %s", checkpoint_dir)
-            self._checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir))
-            # load models from checkpoint
-            self._generator = self._checkpoint.generator
-            self._discriminator = self._checkpoint.discriminator
-            # load optimizers from checkpoint
-            self._generator_optimizer = self._checkpoint.generator_optimizer
-            self._discriminator_optimizer = self._checkpoint.discriminator_optimizer
-            # load weights from checkpoint
-            # self._generator.load_weights(load_checkpoint_file)
-            # self._discriminator.load_weights(load_checkpoint_file)
+            # the chief's checkpoints, for every worker
+            latest_checkpoint = tf.train.latest_checkpoint(checkpoint_dir)
+            if latest_checkpoint is None:
+                logging.warning("No checkpoint to load in: %s", checkpoint_dir)
+            else:
+                logging.info("Loading checkpoint...: %s", latest_checkpoint)
+                # the train iterator is only restored if fit saves it
+                self._checkpoint.restore(latest_checkpoint).expect_partial()
 
     def generate_images(
         self,
@@ -60,61 +186,292 @@ class GanModel:
         image_name: str = "generated_image.png",
     ) -> None:
         """
-        Generates images.
+        Generates images - every image of the batch, in one column (see
+        image_grid).
         :param test_input: the test input
         :param target: the target
         """
-        prediction = self._generator(test_input, training=True)
+        prediction = self.generate(test_input)
+        self.save_images(
+            test_input.numpy(), target.numpy(), prediction.numpy(), image_name
+        )
+
+    def save_images(
+        self,
+        test_input: np.ndarray,
+        target: np.ndarray,
+        prediction: np.ndarray,
+        image_name: str = "generated_image.png",
+    ) -> None:
+        """
+        Saves the images of a prediction (see generate_images) - only numpy
+        arrays, so that it can run in the background while training.
+        :param test_input: the test input
+        :param target: the target
+        :param prediction: the generator prediction of test_input
+        """
         # save test_input, tar and prediction
 
         tf.keras.preprocessing.image.save_img(
             os.path.join(self._save_image_dir, "prediction_" + image_name),
-            prediction[0].numpy(),
+            image_grid(prediction),
         )
         tf.keras.preprocessing.image.save_img(
             os.path.join(self._save_image_dir, "target_" + image_name),
-            target[0].numpy(),
+            image_grid(target),
         )
         tf.keras.preprocessing.image.save_img(
             os.path.join(self._save_image_dir, "test_input_" + image_name),
-            test_input[0].numpy(),
+            image_grid(test_input),
         )
 
+    def generate(self, test_input: tf.Tensor) -> tf.Tensor:
+        """
+        Returns the generator prediction of a batch of input images.
+        """
+        return self._compiled_generate(test_input)
+
+    def _generate(self, test_input: tf.Tensor) -> tf.Tensor:
+        return self._generator(test_input, training=True)
+
     def generate_image(self, test_input: tf.Tensor, image_name: str) -> None:
-        prediction = self._generator(test_input, training=True)
+        prediction = self.generate(test_input)
         logging.info("saving image to file: %s", image_name)
         tf.keras.preprocessing.image.save_img(
             image_name,
             prediction[0].numpy(),
         )
 
-    def fit(self, train_ds, test_ds, steps: int = 40000):
-        example_input, example_target = next(iter(test_ds.take(1)))
-        start = time.time()
+    @property
+    def step(self) -> int:
+        return int(self._step.numpy())
 
-        for step, (input_image, target) in train_ds.repeat().take(steps).enumerate():
-            if (step + 1) % 1000 == 0:
-                if step != 0:
-                    logging.info(
-                        f"Time taken for 1000 steps: {time.time()-start:.2f} sec\n"
-                    )
-                start = time.time()
+    def save_checkpoint(self) -> str:
+        """
+        Saves a checkpoint numbered by the global step (in the background when
+        async_checkpoint is set) - only the max_to_keep latest ones are kept.
+        Workers other than the chief delete theirs once written - they only
+        save because saving is collective.
+        """
+        checkpoint_path = self._checkpoint_manager.save(
+            checkpoint_number=self._step, options=self._checkpoint_options
+        )
+        if not self._chief:
+            self._checkpoint.sync()
+            tf.io.gfile.rmtree(self._checkpoint_manager.directory)
+            return checkpoint_path
+        logging.info("Saved checkpoint: %s", checkpoint_path)
+        return checkpoint_path
 
-                self.generate_images(
-                    example_input, example_target, "step_" + str(step + 1) + ".png"
+    def fit(
+        self,
+        train_ds,
+        test_ds,
+        steps: int = 40000,
+        save_iterator: bool = True,
+        save_every_steps: int = 5000,
+        save_every_secs: Optional[float] = None,
+        summary_every_steps: int = 100,
+        steps_per_execution: int = 1,
+        num_examples: int = 1,
+        image_queue_size: int = 2,
+    ):
+        """
+        Trains the model up to steps (global) steps - a loaded checkpoint
+        resumes from its step.
+        :param train_ds: the train dataset (repeated as needed), batched by the
+            global batch size - or, with a strategy, a dataset function of the
+            tf.distribute.InputContext returning the shard of an input pipeline
+            batched per replica (see get_train_dataset_fn)
+        :param test_ds: the test dataset - its first num_examples examples are
+            used for the images generated while training
+        :param steps: the total number of steps
+        :param save_iterator: save the train iterator (the data order, shuffle
+            buffers and augmentation seeds) in the checkpoints, so that a loaded
+            checkpoint resumes exactly where it stopped - the dataset must be
+            checkpointable (not built from a Python generator) and not
+            distributed. The checkpoints are then synchronous (the asynchronous
+            ones leave it out), and every one holds the shuffle buffers, and the
+            whole content of an in memory cache
+        :param save_every_steps: save a checkpoint every save_every_steps steps
+        :param save_every_secs: also save a checkpoint when the last one is older
+            than save_every_secs seconds (not with multiple workers, they must
+            all save at the same steps)
+        :param summary_every_steps: write the mean losses (and steps/sec) of the
+            last summary_every_steps steps
+        :param steps_per_execution: the number of train steps run by a single
+            compiled call (an in-graph loop over the train iterator) - the
+            images, summaries and checkpoints are done between the calls, so
+            their intervals are rounded up to a multiple of it
+        :param num_examples: the number of test examples of the generated images
+            (one below the other, see generate_images)
+        :param image_queue_size: the number of image dumps waiting at most - the
+            images are generated between the train calls (the generator runs
+            with training=True, it updates the BatchNormalization statistics),
+            and encoded and saved in the background (see BackgroundWriter)
+        """
+        if num_examples < 1:
+            raise ValueError(f"Invalid number of examples: {num_examples}")
+        example_input, example_target = next(
+            iter(test_ds.unbatch().take(num_examples).batch(num_examples))
+        )
+        example_images = (example_input.numpy(), example_target.numpy())
+        start = time.time()
+        last_save = time.time()
+
+        if callable(train_ds):
+            train_iterator = iter(
+                self._strategy.distribute_datasets_from_function(
+                    lambda input_context: train_ds(input_context).repeat()
+                )
+            )
+        elif self._distributed:
+            train_iterator = iter(
+                self._strategy.experimental_distribute_dataset(train_ds.repeat())
+            )
+        else:
+            train_iterator = iter(train_ds.repeat())
+        if save_iterator and self._distributed:
+            logging.warning("The distributed train iterator is not checkpointed")
+        elif save_iterator:
+            if self._checkpoint_options.enable_async:
+                # the asynchronous saves silently leave the iterator out
+                logging.warning("Synchronous checkpoints to save the train iterator")
+                self._checkpoint_options = tf.train.CheckpointOptions(
+                    enable_async=False
                 )
+            # restored on assignment, when a checkpoint was loaded
+            self._checkpoint.train_iterator = train_iterator
+        if save_every_secs is not None and task_id(self._strategy) is not None:
+            logging.warning("No time based checkpoints with multiple workers")
+            save_every_secs = None
+        step = saved_step = summary_step = start_step = self.step
+        summary_time = time.time()
+        if step > 0:
+            logging.info("Resuming training at step: %d", step)
+        image_writer = BackgroundWriter(image_queue_size) if self._chief else None
+        try:
+            while step < steps:
+                num_steps = min(steps_per_execution, steps - step)
+                if crossed(step, step + num_steps, 1000):
+                    if step != start_step:
+                        logging.info(
+                            f"Time taken for {step - start_step} steps: "
+                            f"{time.time()-start:.2f} sec\n"
+                        )
+                    start, start_step = time.time(), step
+
+                    if image_writer is not None:
+                        prediction = self.generate(example_input).numpy()
+                        image_writer.submit(
+                            self.save_images,
+                            *example_images,
+                            prediction,
+                            "step_" + str(step + num_steps) + ".png",
+                        )
+
+                # Training steps
+                self.train(train_iterator, num_steps)
+                previous_step, step = step, step + num_steps
+                if crossed(previous_step, step, summary_every_steps):
+                    steps_per_sec = (step - summary_step) / (time.time() - summary_time)
+                    self._write_summaries(step, steps_per_sec)
+                    summary_step, summary_time = step, time.time()
 
-            self._train_step(input_image, target, step)
-            # Training step
-            if (step + 1) % 100 == 0:
-                logging.info(f"Step: {step+1}")
+                # Save (checkpoint) the model every save_every_steps steps, or
+                # save_every_secs seconds
+                if crossed(previous_step, step, save_every_steps) or (
+                    save_every_secs is not None
+                    and time.time() - last_save >= save_every_secs
+                ):
+                    self.save_checkpoint()
+                    saved_step, last_save = step, time.time()
+
+            if step != summary_step:
+                steps_per_sec = (step - summary_step) / (time.time() - summary_time)
+                self._write_summaries(step, steps_per_sec)
+            if step != saved_step:
+                self.save_checkpoint()
+        finally:
+            # wait for the background writes - also when the training failed
+            if image_writer is not None:
+                image_writer.close()
+            self._checkpoint.sync()
+            self._summary_writer.flush()
+
+    def _write_summaries(self, step: int, steps_per_sec: float) -> None:
+        """
+        Writes the mean losses since the last summary (and resets them).
+        """
+        losses = {
+            name: float(metric.result()) for name, metric in self._loss_metrics.items()
+        }
+        with self._summary_writer.as_default():
+            for name, loss in losses.items():
+                tf.summary.scalar(name, loss, step=step)
+            tf.summary.scalar("steps_per_sec", steps_per_sec, step=step)
+        for metric in self._loss_metrics.values():
+            metric.reset_state()
+        logging.info(
+            "Step: %d - %.2f steps/sec - %s",
+            step,
+            steps_per_sec,
+            ", ".join(f"{name}: {loss:.4f}" for name, loss in losses.items()),
+        )
 
-            # Save (checkpoint) the model every 5k steps
-            if (step + 1) % 5000 == 0:
-                self._checkpoint.save(file_prefix=self._checkpoint_prefix)
+    def train(self, train_iterator, num_steps: int) -> None:
+        """
+        Runs num_steps train steps on batches of train_iterator in one
+        compiled call (no images, summaries or checkpoints).
+        """
+        self._train_steps(train_iterator, tf.constant(num_steps))
 
     @tf.function
-    def _train_step(self, input_image: tf.Tensor, target: tf.Tensor, step):
+    def _train_steps(self, train_iterator, num_steps: tf.Tensor):
+        """
+        Runs num_steps train steps on batches of train_iterator in one call.
+        """
+        for _ in tf.range(num_steps):
+            input_image, target = next(train_iterator)
+            self._strategy.run(self._compiled_train_step, args=(input_image, target))
+            self._step.assign_add(1)
+
+    def _train_step(self, input_image: tf.Tensor, target: tf.Tensor):
+        if self._accumulation_steps == 1:
+            generator_gradients, discriminator_gradients, losses = self._gradients(
+                input_image, target
+            )
+        else:
+            (
+                generator_gradients,
+                discriminator_gradients,
+                losses,
+            ) = self._accumulated_gradients(input_image, target)
+        generator_gradients = self._unscale_gradients(
+            self._generator_optimizer, generator_gradients
+        )
+        discriminator_gradients = self._unscale_gradients(
+            self._discriminator_optimizer, discriminator_gradients
+        )
+
+        self._generator_optimizer.apply_gradients(
+            zip(generator_gradients, self._generator.trainable_variables)
+        )
+        self._discriminator_optimizer.apply_gradients(
+            zip(discriminator_gradients, self._discriminator.trainable_variables)
+        )
+
+        # the losses are divided by the number of replicas (their gradients are
+        # summed across the replicas) - the metrics average the replica means
+        replicas = tf.distribute.get_replica_context().num_replicas_in_sync
+        for name, loss in zip(LOSS_NAMES, losses):
+            self._loss_metrics[name].update_state(loss * replicas)
+
+    def _gradients(self, input_image: tf.Tensor, target: tf.Tensor):
+        """
+        Returns the (scaled, with mixed_float16) gradients of the generator and
+        discriminator losses on a batch, and the losses (see LOSS_NAMES).
+        """
         with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
             gen_output = self._generator(input_image, training=True)
 
@@ -132,22 +489,58 @@ class GanModel:
                 disc_real_output=disc_real_output,
                 disc_generated_output=disc_generated_output,
             )
+            # scaled (on the tapes) with mixed_float16
+            scaled_gen_loss = self._scale_loss(
+                self._generator_optimizer, gen_total_loss
+            )
+            scaled_disc_loss = self._scale_loss(
+                self._discriminator_optimizer, disc_loss
+            )
         generator_gradients = gen_tape.gradient(
-            gen_total_loss, self._generator.trainable_variables
+            scaled_gen_loss, self._generator.trainable_variables
         )
         discriminator_gradients = disc_tape.gradient(
-            disc_loss, self._discriminator.trainable_variables
+            scaled_disc_loss, self._discriminator.trainable_variables
         )
+        losses = [gen_total_loss, gen_gan_loss, gen_l1_loss, disc_loss]
+        return generator_gradients, discriminator_gradients, losses
 
-        self._generator_optimizer.apply_gradients(
-            zip(generator_gradients, self._generator.trainable_variables)
+    def _accumulated_gradients(self, input_image: tf.Tensor, target: tf.Tensor):
+        """
+        Returns the gradients and losses of a batch (see _gradients) averaged
+        over accumulation_steps micro-batches, computed one after the other.
+        """
+        input_images = split_batch(input_image, self._accumulation_steps)
+        targets = split_batch(target, self._accumulation_steps)
+
+        def accumulate(i, generator_gradients, discriminator_gradients, losses):
+            micro_batch_gradients = self._gradients(input_images[i], targets[i])
+            return (i + 1,) + tf.nest.map_structure(
+                tf.add,
+                (generator_gradients, discriminator_gradients, losses),
+                micro_batch_gradients,
+            )
+
+        zeros = (
+            [tf.zeros_like(v) for v in self._generator.trainable_variables],
+            [tf.zeros_like(v) for v in self._discriminator.trainable_variables],
+            [tf.zeros([]) for _ in LOSS_NAMES],
         )
-        self._discriminator_optimizer.apply_gradients(
-            zip(discriminator_gradients, self._discriminator.trainable_variables)
+        # a while loop (not unrolled), so that the micro-batches run in sequence
+        _, *sums = tf.while_loop(
+            lambda i, *_: i < self._accumulation_steps,
+            accumulate,
+            (tf.constant(0),) + zeros,
+            parallel_iterations=1,
         )
+        return tf.nest.map_structure(lambda t: t / self._accumulation_steps, sums)
 
-        with self._summary_writer.as_default():
-            tf.summary.scalar("gen_total_loss", gen_total_loss, step=step)
-            tf.summary.scalar("gen_gan_loss", gen_gan_loss, step=step)
-            tf.summary.scalar("gen_l1_loss", gen_l1_loss, step=step)
-            tf.summary.scalar("disc_loss", disc_loss, step=step)
+    def _scale_loss(self, optimizer, loss: tf.Tensor) -> tf.Tensor:
+        if not self._loss_scaling:
+            return loss
+        return optimizer.get_scaled_loss(loss)
+
+    def _unscale_gradients(self, optimizer, gradients):
+        if not self._loss_scaling:
+            return gradients
+        return optimizer.get_unscaled_gradients(gradients)
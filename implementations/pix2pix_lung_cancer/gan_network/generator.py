@@ -1,17 +1,47 @@
+import math
 from typing import Any, List, Tuple
 import tensorflow as tf
 from collections import namedtuple
 
+from gan_network.distribute import average_loss
+
 
 OUTPUT_CHANNELS = 3
 LAMBDA = 100
+# filters of the first downsample block, doubled by each block up to MAX_FILTERS
+FIRST_FILTERS = 64
+MAX_FILTERS = 512
+# the innermost upsample blocks apply dropout
+DROPOUT_BLOCKS = 3
 
 GeneratorLoss = namedtuple("GeneratorLoss", ["total_loss", "gan_loss", "l1_loss"])
 
 
-def downsample(filters: Any, size: Any, apply_batchnorm=True) -> Any:
+class RecomputedSequential(tf.keras.Sequential):
+    """
+    Block whose activations are not kept for the backward pass, but recomputed
+    from its input (tf.recompute_grad) - trades compute for memory. Its
+    variables are tracked like a plain Sequential, so checkpoints are the same.
+
+    The block must be deterministic (no dropout, its mask would be drawn again)
+    and BatchNormalization updates its moving averages in the recomputation
+    too - harmless here, the generator always runs in training mode.
+    """
+
+    def call(self, inputs, training=None, mask=None):
+        def block(x):
+            # training passed explicitly - the recomputation runs out of the
+            # keras call context
+            for layer in self.layers:
+                x = layer(x, training=training)
+            return x
+
+        return tf.recompute_grad(block)(inputs)
+
+
+def downsample(filters: Any, size: Any, apply_batchnorm=True, recompute=False) -> Any:
     initializer = tf.random_normal_initializer(0.0, 0.02)
-    result = tf.keras.Sequential()
+    result = RecomputedSequential() if recompute else tf.keras.Sequential()
     result.add(
         tf.keras.layers.Conv2D(
             filters,
@@ -28,9 +58,11 @@ def downsample(filters: Any, size: Any, apply_batchnorm=True) -> Any:
     return result
 
 
-def upsample(filters: Any, size: Any, apply_dropout=False) -> Any:
+def upsample(filters: Any, size: Any, apply_dropout=False, recompute=False) -> Any:
     initializer = tf.random_normal_initializer(0.0, 0.02)
-    result = tf.keras.Sequential()
+    # dropout blocks are never recomputed (see RecomputedSequential)
+    recompute = recompute and not apply_dropout
+    result = RecomputedSequential() if recompute else tf.keras.Sequential()
     result.add(
         tf.keras.layers.Conv2DTranspose(
             filters,
@@ -51,29 +83,48 @@ def upsample(filters: Any, size: Any, apply_dropout=False) -> Any:
 # defining the generator network
 
 
-def Generator(input_size: Tuple[int, int] = (256, 256)) -> tf.keras.Model:
-    width, height = input_size
-    inputs = tf.keras.layers.Input(shape=[width, height, 3])
-
+def generator_depth(input_size: Tuple[int, int]) -> int:
+    """
+    Returns the number of downsample blocks of the generator: the U-Net goes
+    down to a 1 pixel high bottleneck - 8 blocks for 256x256, 7 for 128x128.
+    :param input_size: the (height, width) of the images - both multiples of
+        the same power of 2, the smaller side
+    """
+    depth = int(math.log2(min(input_size)))
+    if depth < 1 or any(size % 2**depth for size in input_size):
+        raise ValueError(f"Unsupported generator input size: {input_size}")
+    return depth
+
+
+def Generator(
+    input_size: Tuple[int, int] = (256, 256), recompute: bool = False
+) -> tf.keras.Model:
+    """
+    :param input_size: the (height, width) of the images - sets the depth of
+        the network (see generator_depth)
+    :param recompute: recompute the activations inside the down/up blocks in
+        the backward pass instead of keeping them (only the block outputs,
+        i.e. the skip connections, are kept) - less memory per sample for
+        about one more forward pass of the generator per step
+    """
+    height, width = input_size
+    inputs = tf.keras.layers.Input(shape=[height, width, 3])
+
+    # 256x256: 64, 128, 256, 512, 512, 512, 512, 512 (down to 1x1)
+    down_filters = [
+        min(FIRST_FILTERS * 2**i, MAX_FILTERS)
+        for i in range(generator_depth(input_size))
+    ]
     down_stack = [
-        downsample(64, 4, apply_batchnorm=False),  # (batch_size, 128, 128, 64)
-        downsample(128, 4),  # (batch_size, 64, 64, 128)
-        downsample(256, 4),  # (batch_size, 32, 32, 256)
-        downsample(512, 4),  # (batch_size, 16, 16, 512)
-        downsample(512, 4),  # (batch_size, 8, 8, 512)
-        downsample(512, 4),  # (batch_size, 4, 4, 512)
-        downsample(512, 4),  # (batch_size, 2, 2, 512)
-        downsample(512, 4),  # (batch_size, 1, 1, 512)
+        downsample(filters, 4, apply_batchnorm=i > 0, recompute=recompute)
+        for i, filters in enumerate(down_filters)
     ]
 
+    # 256x256: 512, 512, 512, 512, 256, 128, 64 (up to 128x128, concatenated
+    # with the skips: 1024, 1024, 1024, 1024, 512, 256, 128 channels)
     up_stack = [
-        upsample(512, 4, apply_dropout=True),  # (batch_size, 2, 2, 1024)
-        upsample(512, 4, apply_dropout=True),  # (batch_size, 4, 4, 1024)
-        upsample(512, 4, apply_dropout=True),  # (batch_size, 8, 8, 1024)
-        upsample(512, 4),  # (batch_size, 16, 16, 1024)
-        upsample(256, 4),  # (batch_size, 32, 32, 512)
-        upsample(128, 4),  # (batch_size, 64, 64, 256)
-        upsample(64, 4),  # (batch_size, 128, 128, 128)
+        upsample(filters, 4, apply_dropout=i < DROPOUT_BLOCKS, recompute=recompute)
+        for i, filters in enumerate(reversed(down_filters[:-1]))
     ]
 
     initializer = tf.random_normal_initializer(0.0, 0.02)
@@ -84,7 +135,7 @@ def Generator(input_size: Tuple[int, int] = (256, 256)) -> tf.keras.Model:
         padding="same",
         kernel_initializer=initializer,
         activation="tanh",
-    )  # (batch_size, 256, 256, 3)
+    )  # (batch_size, height, width, 3)
 
     x = inputs
 
@@ -102,6 +153,8 @@ def Generator(input_size: Tuple[int, int] = (256, 256)) -> tf.keras.Model:
         x = tf.keras.layers.Concatenate()([x, skip])
 
     x = last(x)
+    # float32 output (and losses), whatever the compute dtype of the layers
+    x = tf.keras.layers.Activation("linear", dtype="float32")(x)
 
     return tf.keras.Model(inputs=inputs, outputs=x)
 
@@ -109,11 +162,20 @@ def Generator(input_size: Tuple[int, int] = (256, 256)) -> tf.keras.Model:
 def generator_loss(
     disc_generated_output: Any, gen_output: Any, target: Any
 ) -> GeneratorLoss:
-    loss_object = tf.keras.losses.BinaryCrossentropy(from_logits=True)
-
-    gan_loss = loss_object(tf.ones_like(disc_generated_output), disc_generated_output)
+    loss_object = tf.keras.losses.BinaryCrossentropy(
+        from_logits=True, reduction=tf.keras.losses.Reduction.NONE
+    )
+    # the losses are computed in float32 (the outputs of mixed precision
+    # layers may be bfloat16/float16)
+    disc_generated_output = tf.cast(disc_generated_output, tf.float32)
+    gen_output = tf.cast(gen_output, tf.float32)
+    target = tf.cast(target, tf.float32)
+
+    gan_loss = average_loss(
+        loss_object(tf.ones_like(disc_generated_output), disc_generated_output)
+    )
     # mean absolute error
-    l1_loss = tf.reduce_mean(tf.abs(target - gen_output))
+    l1_loss = average_loss(tf.abs(target - gen_output))
     total_gen_loss = gan_loss + (LAMBDA * l1_loss)
 
     return GeneratorLoss(total_loss=total_gen_loss, gan_loss=gan_loss, l1_loss=l1_loss)
@@ -0,0 +1,220 @@
+"""
+Sharded TFRecord format of the (input, real) training pairs.
+
+Every record holds the sketch and the real image separately (each one encoded
+on its own, instead of a side by side png split at every step) along with its
+metadata. Shards are named "pairs-<index>-of-<count>.tfrecord", so listing
+them sorted gives a deterministic order to shard between workers.
+
+Sketches are stored with a single channel, png by default. They can be
+bit-packed instead (SKETCH_ENCODINGS "bits"): 1 bit per pixel (edge /
+background) instead of 3 bytes, expanded back to the 3-channel 0/255 image
+only inside the input pipeline. It is lossy - gray edge pixels are thresholded
+at 128 - so it is opt-in.
+"""
+import logging
+import os
+from typing import Iterable, Optional, Tuple
+import numpy as np
+import tensorflow as tf
+
+from test_data_pipeline import TestImageTuple
+
+RECORD_PATTERN = "pairs-*-of-*.tfrecord"
+ENCODINGS = ["png", "raw"]
+SKETCH_ENCODINGS = ENCODINGS + ["bits"]
+
+
+def has_records(data_dir: str) -> bool:
+    return len(tf.io.gfile.glob(os.path.join(data_dir, RECORD_PATTERN))) > 0
+
+
+def count_records(data_dir: str, num_shards: int = 1, shard_index: int = 0) -> int:
+    """
+    Counts the records of a shard (worker) of data_dir, without decoding them.
+    """
+    files = sorted(tf.io.gfile.glob(os.path.join(data_dir, RECORD_PATTERN)))
+    records = tf.data.TFRecordDataset(files[shard_index::num_shards])
+    return int(records.reduce(np.int64(0), lambda count, _: count + 1))
+
+
+def _bytes_feature(value: bytes) -> tf.train.Feature:
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value: int) -> tf.train.Feature:
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def _encode(image: np.ndarray, encoding: str) -> bytes:
+    if encoding == "png":
+        return tf.io.encode_png(image).numpy()
+    if encoding == "bits":
+        return np.packbits(image.ravel() >= 128).tobytes()
+    return np.ascontiguousarray(image).tobytes()
+
+
+def serialize_pair(
+    name: str,
+    input_image: np.ndarray,
+    real_image: np.ndarray,
+    encoding: str = "raw",
+    sketch_encoding: str = "png",
+) -> bytes:
+    """
+    Serializes a pair of uint8 RGB images (H, W, 3) to a tf.train.Example.
+    The sketch is stored with a single channel - its three channels are equal.
+    """
+    height, width = real_image.shape[:2]
+    sketch = input_image[..., :1]
+    features = {
+        "name": _bytes_feature(name.encode()),
+        "height": _int64_feature(height),
+        "width": _int64_feature(width),
+        "encoding": _bytes_feature(encoding.encode()),
+        "sketch_encoding": _bytes_feature(sketch_encoding.encode()),
+        "input_image": _bytes_feature(_encode(sketch, sketch_encoding)),
+        "real_image": _bytes_feature(_encode(real_image, encoding)),
+    }
+    example = tf.train.Example(features=tf.train.Features(feature=features))
+    return example.SerializeToString()
+
+
+def write_pair_records(
+    pairs: Iterable[Tuple[str, np.ndarray, np.ndarray]],
+    output_dir: str,
+    num_shards: int = 16,
+    encoding: str = "raw",
+    sketch_encoding: str = "png",
+) -> int:
+    """
+    Writes the pairs round robin to num_shards TFRecord files - in their
+    order, so they should come shuffled.
+    :param pairs: (name, input image, real image) - uint8 RGB images
+    :param output_dir: the records directory
+    :param num_shards: the number of shards (files)
+    :param encoding: how the real images are encoded - "png" or "raw"
+    :param sketch_encoding: how the sketches are encoded - "png", "raw" or the
+        lossy "bits"
+    :return: the number of written pairs
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding: {encoding}")
+    if sketch_encoding not in SKETCH_ENCODINGS:
+        raise ValueError(f"Unknown sketch encoding: {sketch_encoding}")
+    os.makedirs(output_dir, exist_ok=True)
+    writers = [
+        tf.io.TFRecordWriter(
+            os.path.join(output_dir, f"pairs-{i:05d}-of-{num_shards:05d}.tfrecord")
+        )
+        for i in range(num_shards)
+    ]
+    total = 0
+    try:
+        for total, (name, input_image, real_image) in enumerate(pairs, start=1):
+            writers[(total - 1) % num_shards].write(
+                serialize_pair(name, input_image, real_image, encoding, sketch_encoding)
+            )
+    finally:
+        for writer in writers:
+            writer.close()
+    logging.info("Wrote %d pairs to %d shards in: %s", total, num_shards, output_dir)
+    return total
+
+
+FEATURE_DESCRIPTION = {
+    "name": tf.io.FixedLenFeature([], tf.string),
+    "height": tf.io.FixedLenFeature([], tf.int64),
+    "width": tf.io.FixedLenFeature([], tf.int64),
+    "encoding": tf.io.FixedLenFeature([], tf.string),
+    # records written before the sketch encoding existed use "encoding"
+    "sketch_encoding": tf.io.FixedLenFeature([], tf.string, default_value=""),
+    "input_image": tf.io.FixedLenFeature([], tf.string),
+    "real_image": tf.io.FixedLenFeature([], tf.string),
+}
+
+
+def _decode(
+    data: tf.Tensor,
+    encoding: tf.Tensor,
+    height: tf.Tensor,
+    width: tf.Tensor,
+    channels: int,
+) -> tf.Tensor:
+    shape = tf.stack([height, width, channels])
+    return tf.case(
+        [
+            (
+                tf.equal(encoding, "png"),
+                lambda: tf.reshape(tf.io.decode_png(data, channels=channels), shape),
+            ),
+            (tf.equal(encoding, "bits"), lambda: unpack_bits(data, shape)),
+        ],
+        default=lambda: tf.reshape(tf.io.decode_raw(data, tf.uint8), shape),
+    )
+
+
+def unpack_bits(data: tf.Tensor, shape: tf.Tensor) -> tf.Tensor:
+    """
+    Expands np.packbits data (most significant bit first) to a 0/255 image.
+    """
+    packed = tf.io.decode_raw(data, tf.uint8)
+    shifts = tf.constant([7, 6, 5, 4, 3, 2, 1, 0], dtype=tf.uint8)
+    bits = tf.bitwise.bitwise_and(
+        tf.bitwise.right_shift(packed[:, tf.newaxis], shifts), 1
+    )
+    bits = tf.reshape(bits, [-1])[: tf.reduce_prod(shape)]
+    return tf.reshape(bits * 255, shape)
+
+
+def parse_pair(serialized: tf.Tensor) -> TestImageTuple:
+    """
+    Parses a record into a uint8 (input, real) pair of RGB images.
+    """
+    example = tf.io.parse_single_example(serialized, FEATURE_DESCRIPTION)
+    height = tf.cast(example["height"], tf.int32)
+    width = tf.cast(example["width"], tf.int32)
+    sketch_encoding = example["sketch_encoding"]
+    sketch_encoding = tf.where(
+        tf.equal(sketch_encoding, ""), example["encoding"], sketch_encoding
+    )
+    sketch = _decode(example["input_image"], sketch_encoding, height, width, 1)
+    real_image = _decode(example["real_image"], example["encoding"], height, width, 3)
+    return TestImageTuple(
+        input_image=tf.image.grayscale_to_rgb(sketch), image=real_image
+    )
+
+
+def get_pair_records_dataset(
+    data_dir: str,
+    num_shards: int = 1,
+    shard_index: int = 0,
+    cycle_length: int = 8,
+    deterministic: bool = False,
+    shuffle_files: bool = False,
+    seed: Optional[int] = None,
+) -> tf.data.Dataset:
+    """
+    Reads the records of data_dir with a parallel interleave over the files.
+    :param num_shards: the number of workers sharing the records
+    :param shard_index: the files of this worker (files are sorted, so the
+        split between the workers is deterministic)
+    :param cycle_length: the number of files read in parallel
+    :param deterministic: keep a deterministic element order
+    :param shuffle_files: read the files of the worker in a new random order at
+        every epoch (the training), instead of the sorted order
+    :param seed: the seed of the file shuffling
+    :return: a dataset of uint8 TestImageTuple
+    """
+    files = sorted(tf.io.gfile.glob(os.path.join(data_dir, RECORD_PATTERN)))
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    dataset = dataset.shard(num_shards, shard_index)
+    if shuffle_files:
+        dataset = dataset.shuffle(len(files), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=cycle_length,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=deterministic,
+    )
+    return dataset.map(parse_pair, num_parallel_calls=tf.data.AUTOTUNE)
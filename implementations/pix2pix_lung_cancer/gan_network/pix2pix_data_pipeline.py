@@ -3,13 +3,44 @@
 2. Randomly flips the image horizontally.
 3. Normalizes the images to [-1, 1].
 https://www.tensorflow.org/tutorials/generative/pix2pix
+
+The augmentation only uses stateless random ops, seeded per element (or per
+batch) by a tf.data.Dataset.random stream: with a seed, the whole train
+pipeline is deterministic and its iterator can be saved in a checkpoint to
+resume training exactly where it stopped.
+
+Decoded uint8 pairs can be cached (in memory or on local disk) before the
+augmentation, so that only the first epoch reads and decodes the images. The
+cache replays the order of its first epoch: cached pairs are stored in one
+random order and only reshuffled by the shuffle buffer after the cache.
 """
-from typing import Tuple
+import hashlib
+import os
+from typing import Callable, Iterator, Optional, Tuple
+import cv2
+import numpy as np
 import tensorflow as tf
 import logging
-from test_data_pipeline import TestImageTuple
+from gan_network.pair_records import (
+    count_records,
+    get_pair_records_dataset,
+    has_records,
+)
+from preprocess.patch_store import PatchStore, list_patches, read_patch_image
+from test_data_pipeline import TestDataPipeline, TestImageTuple, rotation_angles
 
+# the default training resolution - every size of the pipeline derives from it
 ORIGINAL_SIZE = (256, 256)
+CACHE_IN_MEMORY = "memory"
+AUGMENTATIONS = ["batch", "sample"]
+
+
+def jitter_size(image_size: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    Returns the size the train pairs are resized to before the random crop
+    back to image_size - 286x286 for 256x256, as in the pix2pix paper.
+    """
+    return tuple(round(size * 286 / 256) for size in image_size)
 
 
 def resize_image(
@@ -32,12 +63,18 @@ def resize_image(
 def random_crop(
     test_image_tuple: TestImageTuple,
     size: Tuple[int, int] = ORIGINAL_SIZE,
+    seed: Optional[tf.Tensor] = None,
 ) -> TestImageTuple:
     stacked_image = tf.stack(
         [test_image_tuple.input_image, test_image_tuple.image], axis=0
     )
     height, width = size
-    cropped_image = tf.image.random_crop(stacked_image, size=[2, height, width, 3])
+    if seed is None:
+        cropped_image = tf.image.random_crop(stacked_image, size=[2, height, width, 3])
+    else:
+        cropped_image = tf.image.stateless_random_crop(
+            stacked_image, size=[2, height, width, 3], seed=seed
+        )
     return TestImageTuple(input_image=cropped_image[0], image=cropped_image[1])
 
 
@@ -50,16 +87,26 @@ def normalize(test_image_tuple: TestImageTuple) -> TestImageTuple:
 @tf.function()
 def random_jittering(
     test_image_tuple: TestImageTuple,
-    resize: Tuple[int, int] = (286, 286),
+    resize: Optional[Tuple[int, int]] = None,
     original_size: Tuple[int, int] = ORIGINAL_SIZE,
+    seed: Optional[tf.Tensor] = None,
 ) -> TestImageTuple:
-    logging.debug("Applying random jittering...")
-    logging.debug("Resizing to %s...", str(resize))
+    """
+    :param resize: the size before the random crop (None for the
+        jitter_size of original_size)
+    :param original_size: the size of the jittered pair
+    :param seed: the [2] seed of the stateless random ops (stateful ops when
+        None)
+    """
+    resize = resize or jitter_size(original_size)
+    if seed is None:
+        crop_seed, flip = None, tf.random.uniform(()) > 0.5
+    else:
+        crop_seed, flip_seed = tf.unstack(tf.random.split(seed))
+        flip = tf.random.stateless_uniform((), seed=flip_seed) > 0.5
     test_image_tuple = resize_image(test_image_tuple, resize)
-    logging.debug("Randomly cropping back to original size %s...", str(original_size))
-    test_image_tuple = random_crop(test_image_tuple, original_size)
-    logging.debug("Randomly mirroring...")
-    if tf.random.uniform(()) > 0.5:
+    test_image_tuple = random_crop(test_image_tuple, original_size, crop_seed)
+    if flip:
         test_image_tuple = TestImageTuple(
             input_image=tf.image.flip_left_right(test_image_tuple.input_image),
             image=tf.image.flip_left_right(test_image_tuple.image),
@@ -67,27 +114,92 @@ def random_jittering(
     return test_image_tuple
 
 
-def load_image(image_file) -> TestImageTuple:
-    logging.debug("Loading images...")
+def decode_pair(image_file) -> TestImageTuple:
+    """
+    Decodes a side by side png pair into its uint8 (input, real) images.
+    """
     image = tf.io.read_file(image_file)
-    image = tf.image.decode_png(image)
-
-    logging.debug("Splitting input and real images...")
+    image = tf.image.decode_png(image, channels=3)
     w = tf.shape(image)[1]
     w = w // 2
     input_image = image[:, :w, :]
     real_image = image[:, w:, :]
+    return TestImageTuple(input_image=input_image, image=real_image)
 
-    logging.debug("Converting to float32...")
-    input_image = tf.cast(input_image, tf.float32)
-    real_image = tf.cast(real_image, tf.float32)
 
-    return TestImageTuple(input_image=input_image, image=real_image)
+def nearest_indices(in_size: tf.Tensor, out_size: int) -> tf.Tensor:
+    """
+    Source indices of a nearest neighbor resize from in_size to out_size
+    (pixel centers aligned, like tf.image.resize NEAREST_NEIGHBOR).
+    """
+    scale = tf.cast(in_size, tf.float32) / out_size
+    indices = tf.floor((tf.range(out_size, dtype=tf.float32) + 0.5) * scale)
+    return tf.minimum(tf.cast(indices, tf.int32), in_size - 1)
+
+
+def random_jittering_batch(
+    test_image_tuple: TestImageTuple,
+    resize: Optional[Tuple[int, int]] = None,
+    original_size: Tuple[int, int] = ORIGINAL_SIZE,
+    seed: Optional[tf.Tensor] = None,
+) -> TestImageTuple:
+    """
+    random_jittering of a whole (uint8) batch, with a random crop and flip per
+    sample. The resize, crop and flip of a sample only select source pixels,
+    so they are folded into one gather of rows and one gather of columns -
+    the resized images are never materialized and the pixels stay uint8.
+    :param resize: the size before the random crop (None for the
+        jitter_size of original_size)
+    :param original_size: the size of the jittered pairs
+    :param seed: the [2] seed of the (stateless) random crops and flips
+    """
+    resize = resize or jitter_size(original_size)
+    if seed is None:
+        seed = tf.random.uniform([2], maxval=tf.int32.max, dtype=tf.int32)
+    top_seed, left_seed, flip_seed = tf.unstack(tf.random.split(seed, 3))
+    images = tf.concat([test_image_tuple.input_image, test_image_tuple.image], -1)
+    shape = tf.shape(images)
+    batch_size = shape[0]
+    height, width = original_size
+    top = tf.random.stateless_uniform(
+        [batch_size, 1],
+        seed=top_seed,
+        maxval=resize[0] - height + 1,
+        dtype=tf.int32,
+    )
+    left = tf.random.stateless_uniform(
+        [batch_size, 1],
+        seed=left_seed,
+        maxval=resize[1] - width + 1,
+        dtype=tf.int32,
+    )
+    flip = tf.random.stateless_uniform([batch_size, 1], seed=flip_seed) > 0.5
+    columns = tf.range(width)
+    columns = left + tf.where(flip, width - 1 - columns, columns)
+    rows = top + tf.range(height)
+    images = tf.gather(
+        images,
+        tf.gather(nearest_indices(shape[1], resize[0]), rows),
+        axis=1,
+        batch_dims=1,
+    )
+    images = tf.gather(
+        images,
+        tf.gather(nearest_indices(shape[2], resize[1]), columns),
+        axis=2,
+        batch_dims=1,
+    )
+    return TestImageTuple(input_image=images[..., :3], image=images[..., 3:])
+
+
+def load_image(image_file) -> TestImageTuple:
+    logging.debug("Loading images...")
+    return to_float(decode_pair(image_file))
 
 
 def load_train_image(
     real_image_file: str,
-    resize: Tuple[int, int] = (286, 286),
+    resize: Optional[Tuple[int, int]] = None,
     original_size: Tuple[int, int] = ORIGINAL_SIZE,
 ) -> TestImageTuple:
     test_image_tuple = load_image(real_image_file)
@@ -101,7 +213,7 @@ def load_train_image(
 
 def load_test_image(
     real_image_file: str,
-    resize: Tuple[int, int] = (256, 256),
+    resize: Tuple[int, int] = ORIGINAL_SIZE,
 ) -> TestImageTuple:
     test_image_tuple = load_image(real_image_file)
     test_image_tuple = resize_image(test_image_tuple, resize)
@@ -109,25 +221,410 @@ def load_test_image(
     return test_image_tuple
 
 
-def get_train_dataset(input_data_dir: str, buffer_size: int = 400, batch_size: int = 1):
+def will_cache(
+    cache: Optional[str],
+    num_pairs: int,
+    memory_budget_mb: int = 4096,
+    image_size: Tuple[int, int] = ORIGINAL_SIZE,
+) -> bool:
+    """
+    Whether cache_decoded caches the pairs (see its parameters).
+    """
+    if cache is None:
+        return False
+    if cache == CACHE_IN_MEMORY:
+        return cache_size_mb(num_pairs, image_size) <= memory_budget_mb
+    return True
+
+
+def cache_size_mb(num_pairs: int, image_size: Tuple[int, int]) -> float:
+    return num_pairs * 2 * image_size[0] * image_size[1] * 3 / 2**20
+
+
+def cache_file_name(prefix: str, *sources) -> str:
+    """
+    Returns the disk cache file name of a dataset: prefix plus a hash of its
+    sources (absolute data directory, format, parameters...), so that a cache
+    directory shared by several datasets never serves the pairs of another.
+    """
+    key = "\0".join(str(source) for source in sources)
+    return f"{prefix}-{hashlib.sha256(key.encode()).hexdigest()[:16]}"
+
+
+def cache_decoded(
+    dataset: tf.data.Dataset,
+    cache: Optional[str],
+    num_pairs: int,
+    memory_budget_mb: int = 4096,
+    cache_name: str = "train",
+    image_size: Tuple[int, int] = ORIGINAL_SIZE,
+) -> tf.data.Dataset:
+    """
+    Caches a dataset of decoded uint8 pairs (before any augmentation).
+    :param cache: None (no cache), CACHE_IN_MEMORY or a local cache directory
+    :param num_pairs: the number of pairs of the dataset
+    :param memory_budget_mb: the in memory cache is skipped (with a warning)
+        when the pairs do not fit in it
+    :param cache_name: the cache file name inside the cache directory - a disk
+        cache is reused as long as its file exists, so it must be unique per
+        dataset (see cache_file_name)
+    :param image_size: the (height, width) of the images
+    """
+    if cache is None:
+        return dataset
+    if cache == CACHE_IN_MEMORY:
+        cache_mb = cache_size_mb(num_pairs, image_size)
+        if not will_cache(cache, num_pairs, memory_budget_mb, image_size):
+            logging.warning(
+                "Not caching %d pairs (%.0f MB) - over the memory budget of %d MB",
+                num_pairs,
+                cache_mb,
+                memory_budget_mb,
+            )
+            return dataset
+        logging.info(
+            "Caching %d decoded pairs in memory (%.0f MB)", num_pairs, cache_mb
+        )
+        return dataset.cache()
+    os.makedirs(cache, exist_ok=True)
+    logging.info("Caching decoded pairs in: %s", cache)
+    return dataset.cache(os.path.join(cache, cache_name))
+
+
+def get_train_dataset(
+    input_data_dir: str,
+    buffer_size: int = 400,
+    batch_size: int = 1,
+    num_shards: int = 1,
+    shard_index: int = 0,
+    cache: Optional[str] = None,
+    cache_memory_budget_mb: int = 4096,
+    augmentation: str = "batch",
+    seed: Optional[int] = None,
+    image_size: Tuple[int, int] = ORIGINAL_SIZE,
+):
+    """
+    Train dataset of input_data_dir - sharded TFRecords (see pair_records)
+    when the directory has them, the side by side png pairs otherwise.
+    :param num_shards: the number of workers sharing the records
+    :param shard_index: the shard (worker) of this dataset
+    :param cache: cache of the decoded pairs - None, CACHE_IN_MEMORY or a
+        local directory (see cache_decoded)
+    :param cache_memory_budget_mb: the memory budget of the in memory cache
+    :param augmentation: jitter whole batches or every pair (see augment)
+    :param seed: the seed of the shuffling and augmentation - a seeded dataset
+        is deterministic (the records are read in a deterministic order too)
+    :param image_size: the (height, width) of the train pairs - the stored
+        pairs of any size are jittered to it
+    """
     logging.info("Getting train dataset...")
-    train_dataset = tf.data.Dataset.list_files(input_data_dir + "/*.png")
-    train_dataset = train_dataset.map(
-        load_train_image, num_parallel_calls=tf.data.AUTOTUNE
+    source = "records" if has_records(input_data_dir) else "png"
+    if source == "records":
+        logging.info("Reading TFRecord pairs: %s", input_data_dir)
+        train_dataset = get_pair_records_dataset(
+            input_data_dir,
+            num_shards=num_shards,
+            shard_index=shard_index,
+            deterministic=seed is not None,
+            shuffle_files=True,
+            seed=seed,
+        )
+        num_pairs = 0
+        if cache == CACHE_IN_MEMORY:
+            num_pairs = count_records(input_data_dir, num_shards, shard_index)
+    else:
+        # sorted file list, so that sharding is deterministic between workers
+        train_dataset = tf.data.Dataset.list_files(
+            input_data_dir + "/*.png", shuffle=False
+        )
+        train_dataset = train_dataset.shard(num_shards, shard_index)
+        num_pairs = int(train_dataset.cardinality())
+        # a cache would replay the first order anyway: it stores the pairs in
+        # one random order instead of the sorted (same patch) one
+        train_dataset = train_dataset.shuffle(
+            num_pairs,
+            seed=seed,
+            reshuffle_each_iteration=not will_cache(
+                cache, num_pairs, cache_memory_budget_mb
+            ),
+        )
+        train_dataset = train_dataset.map(
+            decode_pair, num_parallel_calls=tf.data.AUTOTUNE
+        )
+    train_dataset = cache_decoded(
+        train_dataset,
+        cache,
+        num_pairs,
+        cache_memory_budget_mb,
+        cache_name=cache_file_name(
+            f"train-{shard_index}-of-{num_shards}",
+            os.path.abspath(input_data_dir),
+            source,
+        ),
     )
-    train_dataset = train_dataset.shuffle(buffer_size)
-    train_dataset = train_dataset.batch(batch_size)
-    return train_dataset
+    # shuffled after the cache, in a new order at every epoch - as uint8, 4
+    # times smaller than the augmented float pairs
+    train_dataset = train_dataset.shuffle(buffer_size, seed=seed)
+    train_dataset = augment(train_dataset, augmentation, batch_size, seed, image_size)
+    return train_dataset.prefetch(tf.data.AUTOTUNE)
 
 
-def get_test_dataset(input_data_dir: str, batch_size: int = 1):
-    logging.info("Getting test dataset...")
-    test_dataset = tf.data.Dataset.list_files(input_data_dir + "/*.png")
-    test_dataset = test_dataset.map(
-        load_test_image, num_parallel_calls=tf.data.AUTOTUNE
+def get_train_dataset_fn(
+    input_data_dir: str, batch_size: int = 1, seed: Optional[int] = None, **kwargs
+) -> Callable[[tf.distribute.InputContext], tf.data.Dataset]:
+    """
+    Train dataset function of a distribution strategy (see
+    distribute_datasets_from_function): every input pipeline (worker) reads
+    its own shard of the records, batched per replica.
+    :param batch_size: the global batch size (across all replicas)
+    :param seed: the seed of the shuffling and augmentation, offset by the
+        input pipeline so that the pipelines draw different jitters
+    :param kwargs: the other arguments of get_train_dataset
+    """
+
+    def dataset_fn(input_context: tf.distribute.InputContext) -> tf.data.Dataset:
+        return get_train_dataset(
+            input_data_dir,
+            batch_size=input_context.get_per_replica_batch_size(batch_size),
+            num_shards=input_context.num_input_pipelines,
+            shard_index=input_context.input_pipeline_id,
+            seed=None if seed is None else seed + input_context.input_pipeline_id,
+            **kwargs,
+        )
+
+    return dataset_fn
+
+
+def streaming_pairs(
+    patches_dir: str,
+    rotate_images: int,
+    crop_policy: str = "border",
+    image_size: Tuple[int, int] = ORIGINAL_SIZE,
+) -> Callable[[bytes], Iterator[Tuple[np.ndarray, np.ndarray]]]:
+    """
+    Returns a generator function yielding the (input, real) uint8 RGB pairs of
+    a patch, generated on the fly by the TestDataPipeline - the same pairs
+    generate_test_data_main.py would save as png.
+    """
+    test_data_pipeline = TestDataPipeline(
+        rotation_augmentation_degree=rotate_images,
+        resize=image_size,
+        crop_policy=crop_policy,
+    )
+    store = PatchStore(patches_dir) if PatchStore.exists(patches_dir) else None
+
+    def generate(image_name: bytes) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        image = read_patch_image(patches_dir, image_name.decode(), store)
+        for test_image in test_data_pipeline.generate_test_image(image):
+            input_image = cv2.bitwise_not(test_image.input_image)
+            input_image = cv2.cvtColor(input_image, cv2.COLOR_GRAY2RGB)
+            # the patches are BGR (the png pairs were decoded as RGB)
+            real_image = cv2.cvtColor(test_image.image, cv2.COLOR_BGR2RGB)
+            yield input_image, real_image
+
+    return generate
+
+
+def to_float(test_image_tuple: TestImageTuple) -> TestImageTuple:
+    return TestImageTuple(
+        input_image=tf.cast(test_image_tuple.input_image, tf.float32),
+        image=tf.cast(test_image_tuple.image, tf.float32),
+    )
+
+
+def treat_train_pair(
+    test_image_tuple: TestImageTuple,
+    seed: Optional[tf.Tensor] = None,
+    image_size: Tuple[int, int] = ORIGINAL_SIZE,
+) -> TestImageTuple:
+    """
+    Jittering (to image_size) and normalization of a decoded uint8 train pair.
+    """
+    test_image_tuple = random_jittering(
+        to_float(test_image_tuple), original_size=image_size, seed=seed
     )
+    return normalize(test_image_tuple)
+
+
+def treat_train_batch(
+    test_image_tuple: TestImageTuple,
+    seed: Optional[tf.Tensor] = None,
+    image_size: Tuple[int, int] = ORIGINAL_SIZE,
+) -> TestImageTuple:
+    """
+    Jittering (per batch to image_size, see random_jittering_batch) and
+    normalization of a batch of decoded uint8 train pairs.
+    """
+    test_image_tuple = random_jittering_batch(
+        test_image_tuple, original_size=image_size, seed=seed
+    )
+    return normalize(to_float(test_image_tuple))
+
+
+def augment(
+    dataset: tf.data.Dataset,
+    augmentation: str,
+    batch_size: int,
+    seed: Optional[int] = None,
+    image_size: Tuple[int, int] = ORIGINAL_SIZE,
+) -> tf.data.Dataset:
+    """
+    Jitters, normalizes and batches a dataset of decoded uint8 train pairs.
+    The last partial batch is dropped: the batches are split between the
+    replicas and in micro-batches (see GanModel).
+    Every pair (or batch) gets its own [2] seed of the stateless random ops
+    from a Dataset.random stream - its state is part of the iterator's, and
+    it draws new seeds at every repetition of the dataset.
+    :param augmentation: one of AUGMENTATIONS - "batch" jitters whole batches
+        (see random_jittering_batch), "sample" every pair on its own
+    :param seed: the seed of the seed stream (None for a random one)
+    :param image_size: the (height, width) of the jittered pairs
+    """
+    seeds = tf.data.Dataset.random(seed=seed, rerandomize_each_iteration=True)
+    seeds = seeds.batch(2)
+    if augmentation == "batch":
+        dataset = tf.data.Dataset.zip(
+            (dataset.batch(batch_size, drop_remainder=True), seeds)
+        )
+        return dataset.map(
+            lambda batch, seed: treat_train_batch(batch, seed, image_size),
+            num_parallel_calls=tf.data.AUTOTUNE,
+        )
+    if augmentation == "sample":
+        dataset = tf.data.Dataset.zip((dataset, seeds))
+        dataset = dataset.map(
+            lambda pair, seed: treat_train_pair(pair, seed, image_size),
+            num_parallel_calls=tf.data.AUTOTUNE,
+        )
+        return dataset.batch(batch_size, drop_remainder=True)
+    raise ValueError(f"Unknown augmentation: {augmentation}")
+
+
+def treat_test_pair(
+    test_image_tuple: TestImageTuple, resize: Tuple[int, int] = ORIGINAL_SIZE
+) -> TestImageTuple:
+    """
+    Resizing and normalization of a decoded uint8 test pair.
+    """
+    test_image_tuple = resize_image(to_float(test_image_tuple), resize)
+    return normalize(test_image_tuple)
+
+
+def to_test_image_tuple(input_image: tf.Tensor, real_image: tf.Tensor):
+    return TestImageTuple(input_image=input_image, image=real_image)
+
+
+def get_streaming_train_dataset(
+    patches_dir: str,
+    rotate_images: int,
+    buffer_size: int = 400,
+    batch_size: int = 1,
+    crop_policy: str = "border",
+    cycle_length: int = 8,
+    cache: Optional[str] = None,
+    cache_memory_budget_mb: int = 4096,
+    augmentation: str = "batch",
+    seed: Optional[int] = None,
+    image_size: Tuple[int, int] = ORIGINAL_SIZE,
+) -> tf.data.Dataset:
+    """
+    Train dataset generated on the fly from the extracted patches (patch store
+    or png patches): the sketch/target pairs are never written to disk, so
+    new rotation or Canny settings need no regenerated png dataset.
+    Patches are interleaved in parallel (cycle_length at a time).
+    :param patches_dir: the patches directory
+    :param rotate_images: the rotation step (in degrees)
+    :param cache: cache of the generated pairs (see cache_decoded) - later
+        epochs replay them instead of generating them again
+    :param augmentation: jitter whole batches or every pair (see augment)
+    :param seed: the seed of the shuffling and augmentation - unlike the
+        get_train_dataset one, this dataset cannot be saved in a checkpoint
+        (the pairs come from a Python generator)
+    :param image_size: the (height, width) of the generated (and jittered) pairs
+    """
+    logging.info("Getting streaming train dataset...")
+    generate = streaming_pairs(patches_dir, rotate_images, crop_policy, image_size)
+    pair_signature = (
+        tf.TensorSpec(shape=[*image_size, 3], dtype=tf.uint8),
+        tf.TensorSpec(shape=[*image_size, 3], dtype=tf.uint8),
+    )
+    patch_names = list_patches(patches_dir)
+    num_pairs = len(patch_names) * (1 + len(rotation_angles(rotate_images)))
+    names = tf.data.Dataset.from_tensor_slices(patch_names)
+    # a single random order when cached (see get_train_dataset)
+    names = names.shuffle(
+        len(names),
+        seed=seed,
+        reshuffle_each_iteration=not will_cache(
+            cache, num_pairs, cache_memory_budget_mb, image_size
+        ),
+    )
+    train_dataset = names.interleave(
+        lambda name: tf.data.Dataset.from_generator(
+            generate, output_signature=pair_signature, args=(name,)
+        ),
+        cycle_length=cycle_length,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=seed is not None,
+    )
+    train_dataset = cache_decoded(
+        train_dataset,
+        cache,
+        num_pairs,
+        cache_memory_budget_mb,
+        cache_name=cache_file_name(
+            f"stream-{rotate_images}-{crop_policy}-{image_size[0]}",
+            os.path.abspath(patches_dir),
+            "store" if PatchStore.exists(patches_dir) else "png",
+            image_size,
+        ),
+        image_size=image_size,
+    )
+    # reshuffled at every epoch, after the cache
+    train_dataset = train_dataset.shuffle(buffer_size, seed=seed)
+    train_dataset = train_dataset.map(to_test_image_tuple)
+    train_dataset = augment(train_dataset, augmentation, batch_size, seed, image_size)
+    return train_dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def get_test_dataset(
+    input_data_dir: str,
+    batch_size: int = 1,
+    image_size: Tuple[int, int] = ORIGINAL_SIZE,
+):
+    """
+    :param image_size: the (height, width) the test pairs are resized to
+    """
+    logging.info("Getting test dataset...")
+    if has_records(input_data_dir):
+        logging.info("Reading TFRecord pairs: %s", input_data_dir)
+        test_dataset = get_pair_records_dataset(input_data_dir, deterministic=True)
+        test_dataset = test_dataset.map(
+            lambda pair: treat_test_pair(pair, image_size),
+            num_parallel_calls=tf.data.AUTOTUNE,
+        )
+    else:
+        test_dataset = tf.data.Dataset.list_files(input_data_dir + "/*.png")
+        test_dataset = test_dataset.map(
+            lambda image_file: load_test_image(image_file, image_size),
+            num_parallel_calls=tf.data.AUTOTUNE,
+        )
     test_dataset = test_dataset.batch(batch_size)
-    return test_dataset
+    return test_dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def load_production_input_image(
+    image_file: str, resize: Tuple[int, int] = ORIGINAL_SIZE
+) -> tf.Tensor:
+    """
+    Loads a pre-processed sketch (see production_main.py) as a generator input.
+    """
+    image = tf.io.read_file(image_file)
+    image = tf.cast(tf.image.decode_png(image, channels=3), tf.float32)
+    image = tf.image.resize(
+        image, resize, method=tf.image.ResizeMethod.NEAREST_NEIGHBOR
+    )
+    return (image / 127.5) - 1
 
 
 def load_fid_inception_image(image_file: str) -> tf.Tensor:
@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 import logging
 import argparse
+import multiprocessing.util
 from argparse import Namespace
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Callable, Generator, Tuple
 import os
 
 import cv2
+import numpy as np
+from tqdm import tqdm
 
-from test_data_pipeline import TestDataPipeline, TestImageTuple
+from preprocess.patch_store import PatchStore, list_patches, read_patch_image
+from test_data_pipeline import CROP_POLICIES, TestDataPipeline, TestImageTuple
 
 
 def parse_args() -> Namespace:
@@ -31,7 +37,26 @@ def parse_args() -> Namespace:
         "--patches_dir",
         type=str,
         default="./data/LUNA_patches",
-        help="patches directory",
+        help="patches directory (patch store or png patches)",
+    )
+    parset.add_argument(
+        "--crop_policy",
+        type=str,
+        choices=CROP_POLICIES,
+        default="border",
+        help="how the rotated images are cropped",
+    )
+    parset.add_argument(
+        "--image_size",
+        type=int,
+        default=256,
+        help="size (square) of the generated pairs",
+    )
+    parset.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes generating the pairs",
     )
 
     return parset.parse_args()
@@ -41,36 +66,142 @@ def get_test_data(
     patches_dir: str,
     rotate_images: int,
     extra_processing: Callable[[TestImageTuple], TestImageTuple] = None,
+    crop_policy: str = "border",
+    image_size: Tuple[int, int] = (256, 256),
 ) -> Generator[Tuple[TestImageTuple, str], None, None]:
     """
     Returns a generator of test data.
     :param data_dir: the data directory
     :param rotate_images: the number of degrees to rotate images
+    :param crop_policy: how the rotated images are cropped
+    :param image_size: the (height, width) of the generated pairs
     :return: a generator of test data and the image name
     """
     test_data_pipeline = TestDataPipeline(
-        rotation_augmentation_degree=rotate_images, resize=(256, 256)
+        rotation_augmentation_degree=rotate_images,
+        resize=image_size,
+        crop_policy=crop_policy,
     )
-    # get only the first image from the data directory
     logging.info("Getting test data...")
-    logging.info("Total images: %d", len(os.listdir(patches_dir)))
     logging.info(
-        "Total images to be generated: %d",
-        len(os.listdir(patches_dir)) * test_data_pipeline.total_images_per_test_image,
+        "Images generated per patch: %d",
+        test_data_pipeline.total_images_per_test_image,
     )
-    for file in os.listdir(patches_dir):
-        if file.endswith(".png"):
-            image_name = file
-            image_path = os.path.join(patches_dir, image_name)
-            image = cv2.imread(image_path)
-            for img_i, test_image in enumerate(
-                test_data_pipeline.generate_test_image(image)
-            ):
-                if extra_processing is not None:
-                    logging.debug("Applying extra processing...")
-                    test_image = extra_processing(test_image)
-                image_complete_name = f"{image_name}_{img_i}"
-                yield test_image, image_complete_name
+    for image_name, image in read_patches(patches_dir):
+        for img_i, test_image in enumerate(
+            test_data_pipeline.generate_test_image(image)
+        ):
+            if extra_processing is not None:
+                logging.debug("Applying extra processing...")
+                test_image = extra_processing(test_image)
+            image_complete_name = f"{image_name}_{img_i}"
+            yield test_image, image_complete_name
+
+
+def read_patches(patches_dir: str) -> Generator[Tuple[str, np.ndarray], None, None]:
+    """
+    Returns a generator of (image name, BGR image) of the extracted patches.
+    Reads the patch store when patches_dir is one, the png patches otherwise.
+    :param patches_dir: the patches directory
+    """
+    store = PatchStore(patches_dir) if PatchStore.exists(patches_dir) else None
+    for image_name in list_patches(patches_dir):
+        yield image_name, read_patch_image(patches_dir, image_name, store)
+
+
+def save_test_image(test_image: TestImageTuple, image_name: str, save_dir: str):
+    """
+    Saves the input (sketch) and real image side by side.
+    """
+    input_image = cv2.bitwise_not(test_image.input_image)
+    # expand dims
+    input_image = cv2.cvtColor(input_image, cv2.COLOR_GRAY2BGR)
+    logging.debug(
+        "Images sizes - input: %s, real: %s",
+        str(test_image.input_image.shape),
+        str(test_image.image.shape),
+    )
+    # concatenate images
+    concatenated_image = cv2.hconcat([input_image, test_image.image])
+    # save image
+    cv2.imwrite(os.path.join(save_dir, f"{image_name}.png"), concatenated_image)
+
+
+# per process state of the pair generation workers
+_worker_state = {}
+
+# pairs generated ahead of their write at most, per worker
+MAX_PENDING_WRITES = 8
+
+
+def _init_worker(
+    patches_dir: str,
+    rotate_images: int,
+    save_dir: str,
+    crop_policy: str = "border",
+    image_size: Tuple[int, int] = (256, 256),
+):
+    _worker_state["patches_dir"] = patches_dir
+    _worker_state["save_dir"] = save_dir
+    _worker_state["store"] = (
+        PatchStore(patches_dir) if PatchStore.exists(patches_dir) else None
+    )
+    _worker_state["pipeline"] = TestDataPipeline(
+        rotation_augmentation_degree=rotate_images,
+        resize=image_size,
+        crop_policy=crop_policy,
+    )
+    # a single writer thread - cv2.imwrite releases the GIL, so encoding and
+    # writing a pair overlaps with generating the next ones
+    _worker_state["writer"] = ThreadPoolExecutor(max_workers=1)
+    _worker_state["pending"] = deque()
+    # the last writes are waited for when the pool stops the worker
+    multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
+
+
+def _close_worker():
+    """
+    Waits for the pending writes of the worker.
+    """
+    pending = _worker_state["pending"]
+    while pending:
+        pending.popleft().result()
+    _worker_state["writer"].shutdown()
+
+
+def _submit_write(test_image: TestImageTuple, image_name: str):
+    """
+    Queues the write of a pair - waits for the oldest write first when
+    MAX_PENDING_WRITES are pending.
+    """
+    pending = _worker_state["pending"]
+    if len(pending) >= MAX_PENDING_WRITES:
+        pending.popleft().result()
+    pending.append(
+        _worker_state["writer"].submit(
+            save_test_image, test_image, image_name, _worker_state["save_dir"]
+        )
+    )
+
+
+def _generate_and_save(image_name: str) -> int:
+    """
+    Generates and saves all the pairs of a patch. Names are derived from the
+    patch name only, so they do not depend on the worker or the order. Every
+    pair is written as soon as it is generated; the writes may still be
+    pending on return.
+    :return: the number of generated pairs
+    """
+    image = read_patch_image(
+        _worker_state["patches_dir"], image_name, _worker_state["store"]
+    )
+    count = 0
+    for img_i, test_image in enumerate(
+        _worker_state["pipeline"].iter_test_images(image)
+    ):
+        _submit_write(test_image, f"{image_name}_{img_i}")
+        count += 1
+    return count
 
 
 def main():
@@ -78,21 +209,27 @@ def main():
     args = parse_args()
     logging.info("Processing with arguments: %s", str(args))
     logging.info("Getting test data...")
-    for test_image, image_name in get_test_data(args.patches_dir, args.rotate_images):
-        input_image = cv2.bitwise_not(test_image.input_image)
-        # expand dims
-        input_image = cv2.cvtColor(input_image, cv2.COLOR_GRAY2BGR)
-        logging.info(
-            "Images sizes - input: %s, real: %s",
-            str(test_image.input_image.shape),
-            str(test_image.image.shape),
-        )
-        # concatenate images
-        concatenated_image = cv2.hconcat([input_image, test_image.image])
-        # save image
-        cv2.imwrite(
-            os.path.join(args.save_dir, f"{image_name}.png"), concatenated_image
-        )
+    os.makedirs(args.save_dir, exist_ok=True)
+    image_names = list_patches(args.patches_dir)
+    initargs = (
+        args.patches_dir,
+        args.rotate_images,
+        args.save_dir,
+        args.crop_policy,
+        (args.image_size, args.image_size),
+    )
+    if args.workers <= 1:
+        _init_worker(*initargs)
+        counts = map(_generate_and_save, image_names)
+        total = sum(tqdm(counts, total=len(image_names)))
+        _close_worker()
+    else:
+        with ProcessPoolExecutor(
+            max_workers=args.workers, initializer=_init_worker, initargs=initargs
+        ) as executor:
+            counts = executor.map(_generate_and_save, image_names, chunksize=4)
+            total = sum(tqdm(counts, total=len(image_names)))
+    logging.info("Saved %d images to: %s", total, args.save_dir)
 
 
 if __name__ == "__main__":
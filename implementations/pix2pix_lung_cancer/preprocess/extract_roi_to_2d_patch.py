@@ -2,25 +2,29 @@
 Extracts the region of interest from the CT scan.
 """
 import ntpath
+from collections import namedtuple
 import pandas as pd
 import numpy as np
-from scipy import ndimage
-import SimpleITK as sitk
 from os.path import join as path_join
 import logging
-from typing import Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
+from mhd_reader import MhdVolume
 
-def normalize_planes(npzarray):
+
+# default Hounsfield units range kept by normalize_planes
+HU_RANGE = (-1000.0, 400.0)
+
+
+def normalize_planes(npzarray, hu_range: Tuple[float, float] = HU_RANGE):
     """
     Normalize pixel depth into Hounsfield units (HU)
 
-    This tries to get all pixels between -1000 and 400 HU.
+    This tries to get all pixels between -1000 and 400 HU (hu_range).
     All other HU will be masked.
 
     """
-    maxHU = 400.0
-    minHU = -1000.0
+    minHU, maxHU = hu_range
 
     npzarray = (npzarray - minHU) / (maxHU - minHU)
     npzarray[npzarray > 1] = 1.0
@@ -28,78 +32,190 @@ def normalize_planes(npzarray):
     return npzarray
 
 
+SeriesCandidates = namedtuple(
+    "SeriesCandidates", ["candidate_ids", "classes", "world_coords", "diameters_mm"]
+)
+
+
+def build_series_index(
+    candidates: pd.DataFrame, annotations: pd.DataFrame
+) -> Dict[str, SeriesCandidates]:
+    """
+    Groups the candidates and annotations by seriesuid once, so that each scan
+    only touches its own rows instead of masking the whole dataframes.
+    Each candidate gets the diameter of the closest annotation of its series
+    (the 50th percentile diameter if the series has no annotation).
+    :param candidates: the candidates dataframe
+    :param annotations: the annotations dataframe
+    :return: a mapping seriesuid -> SeriesCandidates
+    """
+    # Replace the missing diameters with the 50th percentile diameter
+    median_diameter = annotations["diameter_mm"].quantile(0.5)
+    annotations = annotations.assign(
+        diameter_mm=annotations["diameter_mm"].fillna(median_diameter)
+    )
+    annotations_by_series = {
+        seriesuid: (
+            group[["coordX", "coordY", "coordZ"]].values,
+            group["diameter_mm"].values,
+        )
+        for seriesuid, group in annotations.groupby("seriesuid", sort=False)
+    }
+
+    index: Dict[str, SeriesCandidates] = {}
+    for seriesuid, group in candidates.groupby("seriesuid", sort=False):
+        world_coords = group[["coordX", "coordY", "coordZ"]].values
+        diameters = np.full(len(group), median_diameter)
+        if seriesuid in annotations_by_series:
+            annotation_coords, annotation_diameters = annotations_by_series[seriesuid]
+            distances = np.linalg.norm(
+                world_coords[:, np.newaxis, :] - annotation_coords[np.newaxis, :, :],
+                axis=2,
+            )
+            diameters = annotation_diameters[np.argmin(distances, axis=1)]
+        index[seriesuid] = SeriesCandidates(
+            candidate_ids=group.index.values,
+            classes=group["class"].values,
+            world_coords=world_coords,
+            diameters_mm=diameters,
+        )
+    return index
+
+
+def get_series_candidates(
+    index: Dict[str, SeriesCandidates], subject_name: str
+) -> SeriesCandidates:
+    """
+    Returns the candidates of a series (empty if the series has none).
+    """
+    if subject_name in index:
+        return index[subject_name]
+    return SeriesCandidates(
+        candidate_ids=np.empty(0, dtype=int),
+        classes=np.empty(0, dtype=int),
+        world_coords=np.empty((0, 3)),
+        diameters_mm=np.empty(0),
+    )
+
+
+def series_name(img_file: str) -> str:
+    """
+    Returns the seriesuid of a scan - its file name without the .mhd extension.
+    """
+    return ntpath.splitext(ntpath.basename(img_file))[0]
+
+
+# A crop window around a candidate: a fixed half-size in pixels (window), or a
+# diameter adaptive one when diameter_scale is set - the crop side is then
+# diameter_scale times the candidate diameter.
+CropWindow = namedtuple("CropWindow", ["window", "diameter_scale"])
+
+
+def crop_window_name(crop_window: CropWindow) -> str:
+    if crop_window.diameter_scale is not None:
+        return "d{:g}".format(crop_window.diameter_scale)
+    return "w{}".format(crop_window.window)
+
+
+def half_window_size(crop_window: CropWindow, diameter: float) -> int:
+    """
+    Returns the half-size (in pixels) of the crop for a candidate diameter.
+    """
+    if crop_window.diameter_scale is None:
+        return int(crop_window.window)
+    return max(1, int(np.ceil(crop_window.diameter_scale * diameter / 2)))
+
+
 def extract_candidates(
-    img_file: str, candidates: pd.DataFrame, annotations: pd.DataFrame, window: int = 20
+    img_file: str,
+    series_candidates: SeriesCandidates,
+    window: int = 20,
+    classes: Optional[Tuple[int, ...]] = None,
+    hu_range: Tuple[float, float] = HU_RANGE,
 ) -> Tuple[np.ndarray, np.ndarray, float]:
     """
     Extracts the region of interest from the CT scan.
     :param img_file: the path to the CT scan
+    :param series_candidates: the candidates of this scan (see build_series_index)
     :param window: the window size
-    :param candidates: the candidates dataframe
-    :param annotations: the annotations dataframe
+    :param classes: only extract the candidates of these classes (all if None)
+    :param hu_range: the Hounsfield units range kept when normalizing
     :return: the region of interest
     """
-    # Get the name of the file
-    subjectName = ntpath.splitext(ntpath.basename(img_file))[
-        0
-    ]  # Strip off the .mhd extension
+    candidatePatches, candidateValues, candidateDiameter = extract_candidate_windows(
+        img_file,
+        series_candidates,
+        [CropWindow(window=window, diameter_scale=None)],
+        classes,
+        hu_range,
+    )
+    candidatePatches = [patches[0] for patches in candidatePatches]
+    return candidatePatches, candidateValues, candidateDiameter
 
-    # Read the list of candidate ROI
-    dfCandidates = candidates.copy()
-    dfAnnotations = annotations.copy()
 
-    numCandidates = dfCandidates[dfCandidates["seriesuid"] == subjectName].shape[0]
+def extract_candidate_windows(
+    img_file: str,
+    series_candidates: SeriesCandidates,
+    crop_windows: Sequence[CropWindow],
+    classes: Optional[Tuple[int, ...]] = None,
+    hu_range: Tuple[float, float] = HU_RANGE,
+) -> Tuple[List[List[np.ndarray]], np.ndarray, np.ndarray]:
+    """
+    Extracts the regions of interest from the CT scan, at several crop windows
+    in a single pass: the volume is opened once and the z-slice of every
+    candidate is read once, whatever the number of windows.
+    :param img_file: the path to the CT scan
+    :param series_candidates: the candidates of this scan (see build_series_index)
+    :param crop_windows: the crop windows
+    :param classes: only extract the candidates of these classes (all if None)
+    :param hu_range: the Hounsfield units range kept when normalizing
+    :return: the patches (per candidate, one per crop window), the candidate
+        classes and the candidate diameters (in pixels)
+    """
+    # Read if the candidate ROI is a nodule (1) or non-nodule (0)
+    candidateValues = series_candidates.classes
+    numCandidates = candidateValues.shape[0]
     logging.info("There are {} candidate nodules in this file.".format(numCandidates))
 
-    numNonNodules = sum(
-        dfCandidates[dfCandidates["seriesuid"] == subjectName]["class"] == 0
-    )
-    numNodules = sum(
-        dfCandidates[dfCandidates["seriesuid"] == subjectName]["class"] == 1
-    )
+    numNodules = int(np.count_nonzero(candidateValues == 1))
+    numNonNodules = int(np.count_nonzero(candidateValues == 0))
     logging.info(
         "{} are true nodules (class 1) and {} are non-nodules (class 0)".format(
             numNodules, numNonNodules
         )
     )
 
-    # Read if the candidate ROI is a nodule (1) or non-nodule (0)
-    candidateValues = dfCandidates[dfCandidates["seriesuid"] == subjectName][
-        "class"
-    ].values
-
     # Get the world coordinates (mm) of the candidate ROI center
-    worldCoords = dfCandidates[dfCandidates["seriesuid"] == subjectName][
-        ["coordX", "coordY", "coordZ"]
-    ].values
+    worldCoords = series_candidates.world_coords
+
+    diametersMm = series_candidates.diameters_mm
 
-    # Use SimpleITK to read the mhd image
-    itkimage = sitk.ReadImage(img_file)
+    if classes is not None:
+        selected = np.isin(candidateValues, classes)
+        candidateValues = candidateValues[selected]
+        worldCoords = worldCoords[selected]
+        diametersMm = diametersMm[selected]
+        numCandidates = candidateValues.shape[0]
+
+    # Open the mhd image lazily - only the cropped regions are read from disk
+    volume = MhdVolume(img_file)
 
     # Get the real world origin (mm) for this image
     originMatrix = np.tile(
-        itkimage.GetOrigin(), (numCandidates, 1)
+        volume.origin, (numCandidates, 1)
     )  # Real world origin for this image (0,0)
 
     # Subtract the real world origin and scale by the real world (mm per pixel)
     # This should give us the X,Y,Z coordinates for the candidates
     candidatesPixels = (
-        np.round(np.absolute(worldCoords - originMatrix) / itkimage.GetSpacing())
+        np.round(np.absolute(worldCoords - originMatrix) / volume.spacing)
     ).astype(int)
 
-    # Replace the missing diameters with the 50th percentile diameter
-
-    candidateDiameter = (
-        dfAnnotations["diameter_mm"]
-        .fillna(dfAnnotations["diameter_mm"].quantile(0.5))
-        .values
-        / itkimage.GetSpacing()[1]
-    )
+    # Diameters (missing ones already replaced by the median) in pixels
+    candidateDiameter = diametersMm / volume.spacing[1]
 
     candidatePatches = []
 
-    imgAll = sitk.GetArrayFromImage(itkimage)  # Read the image volume
-
     for candNum in range(numCandidates):
         # print('Extracting candidate patch #{}'.format(candNum))
         candidateVoxel = candidatesPixels[candNum, :]
@@ -107,36 +223,41 @@ def extract_candidates(
         ypos = int(candidateVoxel[1])
         zpos = int(candidateVoxel[2])
 
-        # Need to handle the candidates where the window would extend beyond the image boundaries
-        windowSize = window
-        x_lower = np.max([0, xpos - windowSize])  # Return 0 if position off image
-        x_upper = np.min(
-            [xpos + windowSize, itkimage.GetWidth()]
-        )  # Return  maxWidth if position off image
+        # SimpleITK is x,y,z. Numpy is z, y, x.
+        # Read the slice rows covered by the largest window only once
+        windowSizes = [
+            half_window_size(crop_window, candidateDiameter[candNum])
+            for crop_window in crop_windows
+        ]
+        maxWindow = max(windowSizes)
+        rows_lower = np.max([0, ypos - maxWindow])
+        rows_upper = np.min([ypos + maxWindow, volume.get_height()])
+        imgRows = volume[zpos, rows_lower:rows_upper, :]
 
-        y_lower = np.max([0, ypos - windowSize])  # Return 0 if position off image
-        y_upper = np.min(
-            [ypos + windowSize, itkimage.GetHeight()]
-        )  # Return  maxHeight if position off image
+        windowPatches = []
+        for windowSize in windowSizes:
+            # Need to handle the candidates where the window would extend beyond the image boundaries
+            x_lower = np.max([0, xpos - windowSize])  # Return 0 if position off image
+            x_upper = np.min(
+                [xpos + windowSize, volume.get_width()]
+            )  # Return  maxWidth if position off image
 
-        # crop the image for the double of candidate diameter
+            y_lower = np.max([0, ypos - windowSize])  # Return 0 if position off image
+            y_upper = np.min(
+                [ypos + windowSize, volume.get_height()]
+            )  # Return  maxHeight if position off image
 
-        # SimpleITK is x,y,z. Numpy is z, y, x.
-        imgPatch = imgAll[zpos, y_lower:y_upper, x_lower:x_upper]
+            imgPatch = imgRows[
+                y_lower - rows_lower : y_upper - rows_lower, x_lower:x_upper
+            ]
 
-        # Normalize to the Hounsfield units
-        # TODO: I don't think we should normalize into Housefield units
-        imgPatchNorm = normalize_planes(imgPatch)
+            # Normalize to the Hounsfield units
+            # TODO: I don't think we should normalize into Housefield units
+            imgPatchNorm = normalize_planes(imgPatch, hu_range)
+            windowPatches.append(imgPatchNorm)
 
         candidatePatches.append(
-            imgPatchNorm
+            windowPatches
         )  # Append the candidate image patches to a python list
 
     return candidatePatches, candidateValues, candidateDiameter
-
-
-def resize(image, factor=2):
-    # Assuming 'image' is your numpy array
-    zoom_factor = factor  # 2 means doubling the size
-    resized_image = ndimage.zoom(image, zoom_factor)
-    return resized_image
@@ -2,64 +2,321 @@
 import os
 import argparse
 import logging
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List
 import pandas as pd
 from tqdm import tqdm
 import numpy as np
 import matplotlib.pyplot as plt
 
-from extract_roi_to_2d_patch import extract_candidates
-from resize_2d_patch_image import resize
+from extract_roi_to_2d_patch import (
+    HU_RANGE,
+    CropWindow,
+    SeriesCandidates,
+    build_series_index,
+    crop_window_name,
+    extract_candidate_windows,
+    get_series_candidates,
+    half_window_size,
+    series_name,
+)
+from manifest import Manifest, series_fingerprint
+from patch_store import PatchRecord, PatchStore, to_uint8, write_shard
+from resize_2d_patch_image import RESIZE_BACKENDS, resize
+
+SeriesResult = namedtuple(
+    "SeriesResult", ["file_path", "num_patches", "records", "error"]
+)
+
+ExtractionParams = namedtuple(
+    "ExtractionParams",
+    [
+        "window",
+        "zoom_factor",
+        "hu_range",
+        "resize_backend",
+        "patch_size",
+        "extra_windows",
+        "diameter_scales",
+    ],
+)
+# window: crop window (in pixels) around each candidate
+# zoom_factor: upscaling factor of the cropped patch
+# hu_range: the Hounsfield units range kept when normalizing
+# resize_backend: one of RESIZE_BACKENDS
+# patch_size: resize straight to this size (instead of by zoom_factor)
+# extra_windows: other crop windows (in pixels) extracted in the same pass
+# diameter_scales: diameter adaptive crop windows (crop side / diameter)
+DEFAULT_PARAMS = ExtractionParams(
+    window=20,
+    zoom_factor=10.0,
+    hu_range=HU_RANGE,
+    resize_backend="scipy",
+    patch_size=None,
+    extra_windows=(),
+    diameter_scales=(),
+)
+
+
+def crop_windows(params: ExtractionParams) -> List[CropWindow]:
+    """
+    Returns the crop windows of the extraction - the main window first.
+    """
+    windows = [CropWindow(window=params.window, diameter_scale=None)]
+    windows += [CropWindow(window=w, diameter_scale=None) for w in params.extra_windows]
+    windows += [
+        CropWindow(window=None, diameter_scale=scale)
+        for scale in params.diameter_scales
+    ]
+    return windows
+
+
+def patch_name(file_name: str, i: int, window_i: int, crop_window: CropWindow):
+    """
+    Deterministic patch name - the main window keeps the "<seriesuid>_<i>.png"
+    name, the other windows get the window as suffix.
+    """
+    if window_i == 0:
+        return file_name + "_" + str(i) + ".png"
+    return file_name + "_" + str(i) + "_" + crop_window_name(crop_window) + ".png"
 
 
 def process_file(
     file_path: str,
     patches_dir: str,
-    annotations_df: pd.DataFrame,
-    candidates_df: pd.DataFrame,
-):
+    series_candidates: SeriesCandidates,
+    params: ExtractionParams = DEFAULT_PARAMS,
+    export_png: bool = False,
+) -> List[PatchRecord]:
+    """
+    Extracts the positive nodules of a scan (at every crop window, in a single
+    pass over the volume) and writes them to its shard of the patch store in
+    patches_dir.
+    :param params: the extraction parameters
+    :param export_png: also save every patch as a png (debug view)
+    :return: the patch records to be appended to the store index
+    """
     logging.info("Processing file: %s", file_path)
     logging.info("extracting rois for file: %s", file_path)
-    patches_array, values_array, nodule_diameters_array = extract_candidates(
-        file_path, candidates_df, annotations_df, 20
+    windows = crop_windows(params)
+    patches_array, values_array, nodule_diameters_array = extract_candidate_windows(
+        file_path,
+        series_candidates,
+        windows,
+        classes=(1,),
+        hu_range=params.hu_range,
     )
     logging.info("filtering positive nodules...")
     num_positives = np.where(values_array == 1)[0]
     logging.info("total positive nodules: %d", len(num_positives))
+    positives = series_candidates.classes == 1
+    candidate_ids = series_candidates.candidate_ids[positives]
+    world_coords = series_candidates.world_coords[positives]
+    diameters_mm = series_candidates.diameters_mm[positives]
+    file_name = series_name(file_path)
+    patch_size = None
+    if params.patch_size is not None:
+        patch_size = (params.patch_size, params.patch_size)
+    patches = []
+    records = []
     for i, candidate_num in enumerate(num_positives):
         logging.info("processing positive nodule: %d", candidate_num)
-        resized = resize(patches_array[candidate_num], factor=10)
-        logging.info("resizing patch...")
-        # does not resize again, maintains the 400x400 size
-        resized_2 = resized  # cv2.resize(resized, (128, 128))
-        file_name = os.path.splitext(os.path.basename(file_path))[0]
-        fig_name = os.path.join(patches_dir, file_name + "_" + str(i) + ".png")
-        logging.info("saving patch: %s", fig_name)
-        plt.imsave(fig_name, resized_2)
+        for window_i, crop_window in enumerate(windows):
+            logging.info("resizing patch...")
+            # resized by the zoom factor (400x400 by default) or straight to the
+            # final patch size, skipping the intermediate size
+            resized = resize(
+                patches_array[candidate_num][window_i],
+                factor=params.zoom_factor,
+                backend=params.resize_backend,
+                size=patch_size,
+            )
+            patches.append(to_uint8(resized))
+            name = patch_name(file_name, i, window_i, crop_window)
+            if export_png:
+                fig_name = os.path.join(patches_dir, name)
+                logging.info("saving patch: %s", fig_name)
+                plt.imsave(fig_name, resized)
+            records.append(
+                dict(
+                    name=name,
+                    seriesuid=file_name,
+                    candidate_id=int(candidate_ids[candidate_num]),
+                    coordX=world_coords[candidate_num][0],
+                    coordY=world_coords[candidate_num][1],
+                    coordZ=world_coords[candidate_num][2],
+                    diameter_mm=diameters_mm[candidate_num],
+                    window=half_window_size(
+                        crop_window, nodule_diameters_array[candidate_num]
+                    ),
+                )
+            )
+
+    logging.info("saving %d patches to the patch store...", len(patches))
+    shard, locations = write_shard(patches_dir, file_name, patches)
+    return [
+        PatchRecord(**record, shard=shard, offset=offset, height=height, width=width)
+        for record, (offset, height, width) in zip(records, locations)
+    ]
+
+
+def _process_file_safe(
+    file_path: str,
+    patches_dir: str,
+    series_candidates: SeriesCandidates,
+    params: ExtractionParams = DEFAULT_PARAMS,
+    export_png: bool = False,
+) -> SeriesResult:
+    """
+    Runs process_file inside a worker, turning any exception into a
+    per-series failure so one broken scan does not stop the whole pool.
+    """
+    try:
+        records = process_file(
+            file_path, patches_dir, series_candidates, params, export_png
+        )
+        return SeriesResult(
+            file_path=file_path, num_patches=len(records), records=records, error=None
+        )
+    except Exception as e:
+        logging.exception("Failed processing file: %s", file_path)
+        return SeriesResult(
+            file_path=file_path, num_patches=0, records=[], error=repr(e)
+        )
+
+
+def list_mhd_files(data_dirs: List[str]) -> List[str]:
+    """
+    Lists the .mhd files of all data directories, sorted so that the
+    processing order (and the output file names) is deterministic.
+    """
+    all_files = []
+    for data_dir in data_dirs:
+        files = filter(lambda x: x.endswith(".mhd"), os.listdir(data_dir))
+        all_files.extend(os.path.join(data_dir, file) for file in sorted(files))
+    return all_files
 
 
 def preprocess_pipeline(
-    data_dir: str,
+    data_dirs: List[str],
     patches_dir: str,
     annotations_df: pd.DataFrame,
     candidates_df: pd.DataFrame,
-):
-    all_files = os.listdir(data_dir)
-    # filter mhd files
-    all_files = list(filter(lambda x: x.endswith(".mhd"), all_files))
+    workers: int = 1,
+    params: ExtractionParams = DEFAULT_PARAMS,
+    export_png: bool = False,
+    content_hash: bool = False,
+    force: bool = False,
+) -> List[SeriesResult]:
+    """
+    Extracts the positive nodule patches of every .mhd file in data_dirs.
+    Series already in the manifest with the same files, candidates and
+    parameters are skipped, so a crashed or extended run only does the
+    missing work.
+    :param data_dirs: the LUNA16 subset directories
+    :param patches_dir: the patch store directory
+    :param workers: number of worker processes. Each worker holds a full CT
+        volume in memory, so at most `workers` files are in flight at once.
+    :param params: the extraction parameters
+    :param export_png: also save every patch as a png (debug view)
+    :param content_hash: fingerprint the files by sha256 instead of size/mtime
+    :param force: ignore the manifest and process every series
+    :return: the per series results (of the processed series only)
+    """
+    if isinstance(data_dirs, str):
+        data_dirs = [data_dirs]
+    all_files = list_mhd_files(data_dirs)
     logging.info("Total files: %d", len(all_files))
-    for file in tqdm(all_files):
-        file = os.path.join(data_dir, file)
-        process_file(file, patches_dir, annotations_df, candidates_df)
+    os.makedirs(patches_dir, exist_ok=True)
+
+    logging.info("Indexing candidates by seriesuid...")
+    series_index: Dict[str, SeriesCandidates] = build_series_index(
+        candidates_df, annotations_df
+    )
+
+    manifest = Manifest(patches_dir)
+    tasks = []
+    fingerprints = {}
+    for file in all_files:
+        series_candidates = get_series_candidates(series_index, series_name(file))
+        fingerprint = series_fingerprint(
+            file, series_candidates, params._asdict(), content_hash
+        )
+        if not force and manifest.is_up_to_date(series_name(file), fingerprint):
+            continue
+        fingerprints[file] = fingerprint
+        tasks.append((file, patches_dir, series_candidates, params, export_png))
+    logging.info(
+        "Series up to date: %d, to be processed: %d",
+        len(all_files) - len(tasks),
+        len(tasks),
+    )
+
+    store = PatchStore(patches_dir)
+    results: List[SeriesResult] = []
+
+    def collect(result: SeriesResult, progress: tqdm):
+        # the index and the manifest are only written from this (the main)
+        # process - and only after the shard of the series is complete
+        results.append(result)
+        if result.error is None:
+            store.append(result.records, series_name(result.file_path))
+            manifest.record(
+                series_name(result.file_path),
+                fingerprints[result.file_path],
+                result.num_patches,
+            )
+        progress.update(1)
+
+    with tqdm(total=len(tasks)) as progress:
+        if workers <= 1:
+            for task in tasks:
+                collect(_process_file_safe(*task), progress)
+        else:
+            # bounded submission: never queue more files than there are workers,
+            # and recycle the workers to give back the memory of the volumes.
+            # Each task only carries the candidates of its own series.
+            with ProcessPoolExecutor(
+                max_workers=workers, max_tasks_per_child=16
+            ) as executor:
+                pending = set()
+                for task in tasks:
+                    pending.add(executor.submit(_process_file_safe, *task))
+                    if len(pending) >= workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            collect(future.result(), progress)
+                for future in pending:
+                    collect(future.result(), progress)
+
+    failures = [result for result in results if result.error is not None]
+    logging.info(
+        "Processed %d series: %d patches, %d failures",
+        len(results),
+        sum(result.num_patches for result in results),
+        len(failures),
+    )
+    for failure in failures:
+        logging.error("Failed series %s: %s", failure.file_path, failure.error)
+    return results
 
 
 def main():
     # parse args
     parsert = argparse.ArgumentParser()
     parsert.add_argument(
-        "--data_dir", type=str, default="./data", help="data directory"
+        "--data_dir",
+        type=str,
+        nargs="+",
+        default=["./data"],
+        help="data directories (one or more LUNA16 subsets)",
     )
     parsert.add_argument(
-        "--patches_dir", type=str, default="./data/patches", help="patches directory"
+        "--patches_dir",
+        type=str,
+        default="./data/patches",
+        help="patches directory (patch store)",
     )
     parsert.add_argument(
         "--annotations_file",
@@ -73,6 +330,75 @@ def main():
         default="./data/candidates.csv",
         help="candidates file",
     )
+    parsert.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes (each one holds a full CT volume)",
+    )
+    parsert.add_argument(
+        "--window",
+        type=int,
+        default=DEFAULT_PARAMS.window,
+        help="crop window (in pixels) around each candidate",
+    )
+    parsert.add_argument(
+        "--extra_windows",
+        type=int,
+        nargs="*",
+        default=list(DEFAULT_PARAMS.extra_windows),
+        help="other crop windows (in pixels) extracted in the same volume pass",
+    )
+    parsert.add_argument(
+        "--diameter_scales",
+        type=float,
+        nargs="*",
+        default=list(DEFAULT_PARAMS.diameter_scales),
+        help="diameter adaptive crop windows - crop side / nodule diameter "
+        "(e.g. 2 crops the double of the nodule diameter)",
+    )
+    parsert.add_argument(
+        "--zoom_factor",
+        type=float,
+        default=DEFAULT_PARAMS.zoom_factor,
+        help="upscaling factor of the cropped patches",
+    )
+    parsert.add_argument(
+        "--hu_range",
+        type=float,
+        nargs=2,
+        default=list(DEFAULT_PARAMS.hu_range),
+        help="Hounsfield units range (min max) kept when normalizing",
+    )
+    parsert.add_argument(
+        "--resize_backend",
+        type=str,
+        choices=RESIZE_BACKENDS,
+        default=DEFAULT_PARAMS.resize_backend,
+        help="patch resize backend",
+    )
+    parsert.add_argument(
+        "--patch_size",
+        type=int,
+        default=DEFAULT_PARAMS.patch_size,
+        help="resize the patches straight to this size (e.g. 256) "
+        "instead of by the zoom factor",
+    )
+    parsert.add_argument(
+        "--content_hash",
+        action="store_true",
+        help="fingerprint the scans by content (sha256) instead of size/mtime",
+    )
+    parsert.add_argument(
+        "--force",
+        action="store_true",
+        help="ignore the manifest and process every series again",
+    )
+    parsert.add_argument(
+        "--export_png",
+        action="store_true",
+        help="also save every patch as a png (debug view)",
+    )
     args = parsert.parse_args()
 
     logging.basicConfig(level=logging.DEBUG)
@@ -84,7 +410,27 @@ def main():
     logging.info("Loading candidates file: %s", args.candidates_file)
     candidates_df = pd.read_csv(args.candidates_file)
 
-    preprocess_pipeline(args.data_dir, args.patches_dir, annotations_df, candidates_df)
+    results = preprocess_pipeline(
+        args.data_dir,
+        args.patches_dir,
+        annotations_df,
+        candidates_df,
+        workers=args.workers,
+        params=ExtractionParams(
+            window=args.window,
+            zoom_factor=args.zoom_factor,
+            hu_range=tuple(args.hu_range),
+            resize_backend=args.resize_backend,
+            patch_size=args.patch_size,
+            extra_windows=tuple(args.extra_windows),
+            diameter_scales=tuple(args.diameter_scales),
+        ),
+        export_png=args.export_png,
+        content_hash=args.content_hash,
+        force=args.force,
+    )
+    if any(result.error is not None for result in results):
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":
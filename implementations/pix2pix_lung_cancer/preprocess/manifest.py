@@ -0,0 +1,112 @@
+"""
+Manifest of the already processed series, so that preprocessing can be resumed
+and rerun incrementally.
+
+Each series is recorded with a fingerprint of its inputs: the size/mtime
+(optionally the sha256) of its .mhd/.raw files, a hash of its candidates and
+the extraction parameters. A series is only processed again when its
+fingerprint changes.
+"""
+import hashlib
+import json
+import os
+from typing import Any, Dict
+
+import numpy as np
+
+from extract_roi_to_2d_patch import SeriesCandidates
+from mhd_reader import read_mhd_header
+
+MANIFEST_FILE = "manifest.json"
+
+
+def _sha256(file_path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_stats(file_path: str, content_hash: bool) -> Dict[str, Any]:
+    stat = os.stat(file_path)
+    stats = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if content_hash:
+        stats["sha256"] = _sha256(file_path)
+    return stats
+
+
+def candidates_hash(series_candidates: SeriesCandidates) -> str:
+    """
+    Hashes the candidates of a series - so that editing the candidates file
+    only invalidates the series whose rows changed.
+    """
+    digest = hashlib.sha1()
+    for values in series_candidates:
+        digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
+
+
+def series_fingerprint(
+    mhd_file: str,
+    series_candidates: SeriesCandidates,
+    params: Dict[str, Any],
+    content_hash: bool = False,
+) -> Dict[str, Any]:
+    """
+    Returns the fingerprint of everything a series' patches depend on.
+    :param mhd_file: the path to the .mhd file
+    :param series_candidates: the candidates of the series
+    :param params: the extraction parameters (window, zoom factor, HU range...)
+    :param content_hash: also hash the file contents (slower than size/mtime)
+    """
+    files = {os.path.basename(mhd_file): _file_stats(mhd_file, content_hash)}
+    data_file = read_mhd_header(mhd_file).get("ElementDataFile", "LOCAL")
+    raw_file = os.path.join(os.path.dirname(mhd_file), data_file)
+    if data_file != "LOCAL" and os.path.isfile(raw_file):
+        files[data_file] = _file_stats(raw_file, content_hash)
+    return {
+        "files": files,
+        "candidates": candidates_hash(series_candidates),
+        # round trip through json so that tuples compare equal to saved lists
+        "params": json.loads(json.dumps(params)),
+    }
+
+
+class Manifest:
+    """
+    The processed series of a patch store, saved as json next to its index.
+    """
+
+    def __init__(self, store_dir: str):
+        """
+        param store_dir: the patch store directory
+        """
+        self._manifest_file = os.path.join(store_dir, MANIFEST_FILE)
+        self._series: Dict[str, Dict[str, Any]] = {}
+        if os.path.isfile(self._manifest_file):
+            with open(self._manifest_file) as f:
+                self._series = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self._series)
+
+    def is_up_to_date(self, seriesuid: str, fingerprint: Dict[str, Any]) -> bool:
+        entry = self._series.get(seriesuid)
+        return entry is not None and entry["fingerprint"] == fingerprint
+
+    def record(
+        self, seriesuid: str, fingerprint: Dict[str, Any], num_patches: int
+    ) -> None:
+        """
+        Records a processed series and saves the manifest (atomically, so a
+        crash never leaves a truncated file behind).
+        """
+        self._series[seriesuid] = {
+            "fingerprint": fingerprint,
+            "num_patches": num_patches,
+        }
+        tmp_file = self._manifest_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._series, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self._manifest_file)
@@ -0,0 +1,166 @@
+"""
+Lazy reader for MetaImage (.mhd/.raw) CT volumes.
+
+Uncompressed volumes are memory-mapped, so cropping a patch only reads the
+pages of the requested z-slice rows instead of the whole volume.
+Compressed (or otherwise unsupported) volumes fall back to SimpleITK.
+"""
+import os
+import logging
+from typing import Dict, Tuple
+import numpy as np
+import SimpleITK as sitk
+
+ELEMENT_TYPES = {
+    "MET_CHAR": np.int8,
+    "MET_UCHAR": np.uint8,
+    "MET_SHORT": np.int16,
+    "MET_USHORT": np.uint16,
+    "MET_INT": np.int32,
+    "MET_UINT": np.uint32,
+    "MET_LONG": np.int64,
+    "MET_ULONG": np.uint64,
+    "MET_FLOAT": np.float32,
+    "MET_DOUBLE": np.float64,
+}
+
+
+def read_mhd_header(mhd_file: str) -> Dict[str, str]:
+    """
+    Parses the "key = value" lines of a .mhd header.
+    :param mhd_file: the path to the .mhd file
+    :return: the header fields
+    """
+    header: Dict[str, str] = {}
+    with open(mhd_file, "rb") as f:
+        for raw_line in f:
+            line = raw_line.decode("latin-1").strip()
+            if "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            header[key.strip()] = value.strip()
+            # the data of a LOCAL file starts right after this line
+            if key.strip() == "ElementDataFile":
+                break
+    return header
+
+
+class MhdVolume:
+    """
+    A CT volume that is read slice by slice.
+    Indexing follows the numpy convention (z, y, x), like sitk.GetArrayFromImage.
+    """
+
+    def __init__(self, mhd_file: str):
+        """
+        param mhd_file: the path to the .mhd file
+        """
+        self._mhd_file = mhd_file
+        self._array = None
+        header = read_mhd_header(mhd_file)
+        if self._can_memory_map(header):
+            self._open_memory_map(header)
+        else:
+            logging.debug("Falling back to SimpleITK for file: %s", mhd_file)
+            self._open_simple_itk()
+
+    @property
+    def origin(self) -> Tuple[float, float, float]:
+        """
+        Real world origin (mm) of the volume - x, y, z.
+        """
+        return self._origin
+
+    @property
+    def spacing(self) -> Tuple[float, float, float]:
+        """
+        Real world size (mm) of a voxel - x, y, z.
+        """
+        return self._spacing
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        """
+        Shape of the volume - z, y, x.
+        """
+        return self._array.shape
+
+    @property
+    def is_memory_mapped(self) -> bool:
+        return isinstance(self._array, np.memmap)
+
+    def get_width(self) -> int:
+        return self.shape[2]
+
+    def get_height(self) -> int:
+        return self.shape[1]
+
+    def __getitem__(self, key) -> np.ndarray:
+        """
+        Reads only the requested region of the volume into memory.
+        """
+        return np.array(self._array[key])
+
+    @staticmethod
+    def _can_memory_map(header: Dict[str, str]) -> bool:
+        if header.get("CompressedData", "False").lower() == "true":
+            return False
+        if header.get("ElementType") not in ELEMENT_TYPES:
+            return False
+        if int(header.get("NDims", "3")) != 3:
+            return False
+        if int(header.get("ElementNumberOfChannels", "1")) != 1:
+            return False
+        data_file = header.get("ElementDataFile", "")
+        # a LIST of slice files (or a file pattern) is left for SimpleITK
+        return (
+            data_file != ""
+            and not data_file.startswith("LIST")
+            and " " not in data_file
+        )
+
+    def _open_memory_map(self, header: Dict[str, str]):
+        size_x, size_y, size_z = (int(v) for v in header["DimSize"].split())
+        dtype = np.dtype(ELEMENT_TYPES[header["ElementType"]])
+        msb = header.get(
+            "BinaryDataByteOrderMSB", header.get("ElementByteOrderMSB", "False")
+        )
+        dtype = dtype.newbyteorder(">" if msb.lower() == "true" else "<")
+
+        data_file = header["ElementDataFile"]
+        if data_file == "LOCAL":
+            raw_file = self._mhd_file
+            offset = self._local_data_offset()
+        else:
+            raw_file = os.path.join(os.path.dirname(self._mhd_file), data_file)
+            offset = int(header.get("HeaderSize", "0"))
+        if offset == -1:
+            # HeaderSize = -1 means the data is at the end of the file
+            data_size = size_x * size_y * size_z * dtype.itemsize
+            offset = os.path.getsize(raw_file) - data_size
+
+        self._array = np.memmap(
+            raw_file,
+            dtype=dtype,
+            mode="r",
+            offset=offset,
+            shape=(size_z, size_y, size_x),
+        )
+        origin = header.get("Offset", header.get("Origin", "0 0 0"))
+        self._origin = tuple(float(v) for v in origin.split())
+        self._spacing = tuple(
+            float(v) for v in header.get("ElementSpacing", "1 1 1").split()
+        )
+
+    def _local_data_offset(self) -> int:
+        with open(self._mhd_file, "rb") as f:
+            for raw_line in iter(f.readline, b""):
+                if raw_line.decode("latin-1").strip().startswith("ElementDataFile"):
+                    return f.tell()
+        raise ValueError("ElementDataFile not found in: " + self._mhd_file)
+
+    def _open_simple_itk(self):
+        itkimage = sitk.ReadImage(self._mhd_file)
+        self._array = sitk.GetArrayFromImage(itkimage)
+        self._origin = itkimage.GetOrigin()
+        self._spacing = itkimage.GetSpacing()
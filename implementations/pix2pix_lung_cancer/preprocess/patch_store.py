@@ -0,0 +1,261 @@
+"""
+Compact, append-only store of the extracted 2D nodule patches.
+
+Layout of a store directory:
+    shards/<seriesuid>.npy - the uint8 pixels of all patches of a series,
+                             flattened and concatenated
+    index.csv              - one row per patch (see PATCH_INDEX_COLUMNS), plus
+                             the generation (append time) of the row
+
+Shards are written by the workers, the index is appended by a single writer.
+Patches are read back as zero-copy views of the memory-mapped shards.
+"""
+import logging
+import os
+import time
+from collections import namedtuple
+from typing import Dict, Iterator, List, Optional, Tuple
+import cv2
+import numpy as np
+import pandas as pd
+
+INDEX_FILE = "index.csv"
+SHARDS_DIR = "shards"
+
+PATCH_INDEX_COLUMNS = [
+    "name",
+    "seriesuid",
+    "candidate_id",
+    "coordX",
+    "coordY",
+    "coordZ",
+    "diameter_mm",
+    "window",
+    "shard",
+    "offset",
+    "height",
+    "width",
+]
+
+INT_INDEX_COLUMNS = ["candidate_id", "window", "offset", "height", "width"]
+
+PatchRecord = namedtuple("PatchRecord", PATCH_INDEX_COLUMNS)
+
+
+def to_uint8(patch: np.ndarray) -> np.ndarray:
+    """
+    Quantizes a normalized [0, 1] patch to uint8.
+    """
+    return np.round(np.clip(patch, 0.0, 1.0) * 255).astype(np.uint8)
+
+
+def to_bgr_image(patch: np.ndarray, colormap: str = "viridis") -> np.ndarray:
+    """
+    Renders a stored patch as the BGR image that used to be saved with
+    plt.imsave (min-max stretched and colormapped), for the stages that
+    still expect it.
+    :param patch: the uint8 patch
+    :param colormap: the matplotlib colormap
+    :return: the BGR uint8 image
+    """
+    from matplotlib import colormaps
+
+    lut = np.round(colormaps[colormap](np.arange(256))[:, :3] * 255).astype(np.uint8)
+    low, high = int(patch.min()), int(patch.max())
+    if high > low:
+        stretched = (patch.astype(np.float32) - low) * (255.0 / (high - low))
+        patch = np.round(stretched).astype(np.uint8)
+    else:
+        patch = np.zeros_like(patch)
+    return lut[patch][..., ::-1]
+
+
+def write_shard(
+    store_dir: str, seriesuid: str, patches: List[np.ndarray]
+) -> Tuple[str, List[Tuple[int, int, int]]]:
+    """
+    Writes the patches of one series to its shard (atomically).
+    :param store_dir: the store directory
+    :param seriesuid: the series the patches belong to
+    :param patches: the uint8 patches
+    :return: the shard name and the (offset, height, width) of every patch
+    """
+    shards_dir = os.path.join(store_dir, SHARDS_DIR)
+    os.makedirs(shards_dir, exist_ok=True)
+    shard = seriesuid + ".npy"
+    locations = []
+    offset = 0
+    for patch in patches:
+        locations.append((offset, patch.shape[0], patch.shape[1]))
+        offset += patch.size
+    if patches:
+        data = np.concatenate([patch.ravel() for patch in patches])
+    else:
+        data = np.empty(0, dtype=np.uint8)
+    tmp_file = os.path.join(shards_dir, seriesuid + ".tmp.npy")
+    np.save(tmp_file, data.astype(np.uint8, copy=False))
+    os.replace(tmp_file, os.path.join(shards_dir, shard))
+    return shard, locations
+
+
+class PatchStore:
+    """
+    Reader/writer of the patch index and shards.
+    """
+
+    def __init__(self, store_dir: str):
+        """
+        param store_dir: the store directory
+        """
+        self._store_dir = store_dir
+        self._index_file = os.path.join(store_dir, INDEX_FILE)
+        self._index = None
+        self._positions: Dict[str, int] = None
+        self._shards: Dict[str, np.ndarray] = {}
+
+    @staticmethod
+    def exists(store_dir: str) -> bool:
+        return os.path.isfile(os.path.join(store_dir, INDEX_FILE))
+
+    @property
+    def index(self) -> pd.DataFrame:
+        """
+        The patch index - when a series was appended again, only the rows of
+        its last generation are kept.
+        """
+        if self._index is None:
+            if not self.exists(self._store_dir):
+                self._index = pd.DataFrame(columns=PATCH_INDEX_COLUMNS)
+            else:
+                index = self._read_index()
+                last_generation = index.groupby("seriesuid")["generation"].transform(
+                    "max"
+                )
+                index = index[index["generation"] == last_generation]
+                # the empty rows of the series reprocessed without any patch
+                index = index.dropna(subset=["name"]).astype(
+                    {column: np.int64 for column in INT_INDEX_COLUMNS}
+                )
+                self._index = index.drop_duplicates(
+                    subset=["name"], keep="last"
+                ).reset_index(drop=True)[PATCH_INDEX_COLUMNS]
+        return self._index
+
+    def _read_index(self) -> pd.DataFrame:
+        index = pd.read_csv(self._index_file, dtype={"seriesuid": str})
+        if "generation" not in index.columns:
+            # written before the generations: a single one
+            index["generation"] = 0
+        return index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def append(
+        self, records: List[PatchRecord], seriesuid: Optional[str] = None
+    ) -> None:
+        """
+        Appends the records of a series to the index, in place of its previous
+        rows. Must be called by a single writer, with all the records of a
+        series at once.
+        :param records: the patch records of the series
+        :param seriesuid: the series - needed to drop its previous rows when it
+            has no records anymore
+        """
+        if records:
+            rows = pd.DataFrame(records, columns=PATCH_INDEX_COLUMNS)
+        elif seriesuid is not None and self.exists(self._store_dir):
+            # an empty row, for the new generation to hide the previous rows
+            rows = pd.DataFrame(
+                [dict(seriesuid=seriesuid)], columns=PATCH_INDEX_COLUMNS
+            )
+        else:
+            return
+        os.makedirs(self._store_dir, exist_ok=True)
+        self._upgrade_index()
+        rows["generation"] = time.time_ns()
+        rows.to_csv(
+            self._index_file,
+            mode="a",
+            header=not self.exists(self._store_dir),
+            index=False,
+        )
+        self._index = None
+        self._positions = None
+
+    def _upgrade_index(self) -> None:
+        """
+        Adds the generation column to an index written before it (its rows
+        become generation 0), so that rows can be appended to it.
+        """
+        if not self.exists(self._store_dir):
+            return
+        with open(self._index_file) as f:
+            if "generation" in f.readline().rstrip("\n").split(","):
+                return
+        tmp_file = self._index_file + ".tmp"
+        self._read_index().to_csv(tmp_file, index=False)
+        os.replace(tmp_file, self._index_file)
+
+    def read_patch(self, i: int) -> np.ndarray:
+        """
+        Returns the i-th patch as a read-only view of its memory-mapped shard.
+        """
+        record = self.index.iloc[i]
+        return self._read(record.shard, record.offset, record.height, record.width)
+
+    def get_patch(self, name: str) -> np.ndarray:
+        """
+        Returns the patch with this name (see read_patch).
+        """
+        if self._positions is None:
+            self._positions = {name: i for i, name in enumerate(self.index["name"])}
+        return self.read_patch(self._positions[name])
+
+    def iter_patches(self) -> Iterator[Tuple[PatchRecord, np.ndarray]]:
+        """
+        Iterates over (record, patch) of all patches in the store.
+        """
+        for record in self.index.itertuples(index=False, name="PatchRecord"):
+            yield record, self._read(
+                record.shard, record.offset, record.height, record.width
+            )
+
+    def _read(self, shard: str, offset: int, height: int, width: int) -> np.ndarray:
+        if shard not in self._shards:
+            self._shards[shard] = np.load(
+                os.path.join(self._store_dir, SHARDS_DIR, shard), mmap_mode="r"
+            )
+        offset = int(offset)
+        size = int(height) * int(width)
+        return self._shards[shard][offset : offset + size].reshape(
+            int(height), int(width)
+        )
+
+
+def list_patches(patches_dir: str) -> List[str]:
+    """
+    Returns the (sorted) names of the extracted patches.
+    :param patches_dir: the patches directory (patch store or png patches)
+    """
+    if PatchStore.exists(patches_dir):
+        names = sorted(PatchStore(patches_dir).index["name"])
+        logging.info("Total images (patch store): %d", len(names))
+        return names
+    names = sorted(file for file in os.listdir(patches_dir) if file.endswith(".png"))
+    logging.info("Total images: %d", len(names))
+    return names
+
+
+def read_patch_image(
+    patches_dir: str, image_name: str, store: Optional[PatchStore] = None
+) -> np.ndarray:
+    """
+    Returns the BGR image of a patch.
+    :param patches_dir: the patches directory (patch store or png patches)
+    :param image_name: the patch name
+    :param store: the patch store, when patches_dir is one
+    """
+    if store is not None:
+        return to_bgr_image(store.get_patch(image_name))
+    return cv2.imread(os.path.join(patches_dir, image_name))
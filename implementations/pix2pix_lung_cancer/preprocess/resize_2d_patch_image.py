@@ -1,12 +1,92 @@
 """
 Resize 2D patch image to 128x128 - as in the paper
+
+Several backends are available (see RESIZE_BACKENDS):
+- scipy: ndimage.zoom cubic spline (the original, slowest)
+- cv2_linear / cv2_area / cv2_cubic: OpenCV interpolations
+- numpy_bilinear: bilinear interpolation that also works on batches (N, H, W)
 """
+from typing import Optional, Tuple
 from scipy import ndimage
 import numpy as np
+import cv2
+
+RESIZE_BACKENDS = ["scipy", "cv2_linear", "cv2_area", "cv2_cubic", "numpy_bilinear"]
+
+CV2_INTERPOLATIONS = {
+    "cv2_linear": cv2.INTER_LINEAR,
+    "cv2_area": cv2.INTER_AREA,
+    "cv2_cubic": cv2.INTER_CUBIC,
+}
+
+
+def output_size(
+    image: np.ndarray, factor: float, size: Optional[Tuple[int, int]]
+) -> Tuple[int, int]:
+    """
+    Returns the (height, width) of the resized image.
+    """
+    if size is not None:
+        return size
+    return (
+        int(round(image.shape[-2] * factor)),
+        int(round(image.shape[-1] * factor)),
+    )
+
+
+def bilinear_resize(images: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    """
+    Bilinear resize (pixel centers aligned like cv2.INTER_LINEAR) of an image
+    or of a batch of images (..., H, W).
+    :param images: the images
+    :param size: the (height, width) of the output
+    """
+    in_height, in_width = images.shape[-2:]
+    height, width = size
+
+    def coordinates(out_size: int, in_size: int):
+        coords = (np.arange(out_size) + 0.5) * (in_size / out_size) - 0.5
+        coords = np.clip(coords, 0, in_size - 1)
+        lower = np.floor(coords).astype(np.intp)
+        upper = np.minimum(lower + 1, in_size - 1)
+        return lower, upper, coords - lower
+
+    y0, y1, wy = coordinates(height, in_height)
+    x0, x1, wx = coordinates(width, in_width)
+    images = images.astype(np.float32, copy=False)
+    top = images[..., y0, :] * (1 - wy)[:, None] + images[..., y1, :] * wy[:, None]
+    return top[..., x0] * (1 - wx) + top[..., x1] * wx
 
 
-def resize(image: np.ndarray, factor=2):
-    # Assuming 'image' is your numpy array
-    zoom_factor = factor  # 2 means doubling the size
-    resized_image = ndimage.zoom(image, zoom_factor)
-    return resized_image
+def resize(
+    image: np.ndarray,
+    factor=2,
+    backend: str = "scipy",
+    size: Optional[Tuple[int, int]] = None,
+) -> np.ndarray:
+    """
+    Resizes a patch by a zoom factor, or straight to size (height, width).
+    :param image: the patch
+    :param factor: the zoom factor (ignored when size is given)
+    :param backend: one of RESIZE_BACKENDS
+    :param size: the final (height, width), skipping intermediate sizes
+    :return: the resized patch
+    """
+    if backend == "scipy":
+        if size is None:
+            # Assuming 'image' is your numpy array
+            zoom_factor = factor  # 2 means doubling the size
+        else:
+            zoom_factor = (size[0] / image.shape[0], size[1] / image.shape[1])
+        resized_image = ndimage.zoom(image, zoom_factor)
+        return resized_image
+    height, width = output_size(image, factor, size)
+    if backend in CV2_INTERPOLATIONS:
+        return cv2.resize(
+            image.astype(np.float32, copy=False),
+            (width, height),
+            interpolation=CV2_INTERPOLATIONS[backend],
+        )
+    if backend == "numpy_bilinear":
+        return bilinear_resize(image, (height, width))
+    raise ValueError(f"Unknown resize backend: {backend}")
@@ -10,7 +10,7 @@ import tensorflow as tf
 
 from input_image_generator.extract_border import extract_canny_border
 from gan_network.pix2pix_data_pipeline import load_production_input_image
-from gan_network.gan_model import GanModel
+from gan_network.gan_model import PRECISIONS, GanModel
 
 
 def pre_process_sketch(
@@ -33,6 +33,22 @@ def parse_args() -> argparse.Namespace:
     parsert = argparse.ArgumentParser()
     parsert.add_argument("--out", type=str, default="./out.png", help="Output file")
     parsert.add_argument("--sketch", type=str, help="Sketch file to be processed")
+    parsert.add_argument(
+        "--image_size",
+        type=int,
+        default=256,
+        help="resolution (square) the model was trained at",
+    )
+    parsert.add_argument(
+        "--jit", action="store_true", help="compile the generator with XLA"
+    )
+    parsert.add_argument(
+        "--precision",
+        type=str,
+        choices=PRECISIONS,
+        default="float32",
+        help="compute dtype policy of the generator",
+    )
     return parsert.parse_args()
 
 
@@ -63,7 +79,8 @@ def main():
         input_image_file_name,
     )
     cv2.imwrite(input_image_file_name, pre_processed_sketch)
-    input_image_treated = load_production_input_image(input_image_file_name)
+    image_size = (args.image_size, args.image_size)
+    input_image_treated = load_production_input_image(input_image_file_name, image_size)
     logging.info("Loading GAN model...")
     CHKPT_DIR = "./data/checkpoints_2"
     LOG_DIR = "./data/logs"
@@ -72,7 +89,10 @@ def main():
         checkpoint_dir=CHKPT_DIR,
         save_image_dir=GENERATED_IMGS_DIR,
         log_dir=LOG_DIR,
+        input_size=image_size,
         load_checkpoint=True,
+        jit_compile=args.jit,
+        precision=args.precision,
     )
     logging.info("Generating images...")
     gan_model.generate_image(input_image_treated[tf.newaxis, ...], args.out)
@@ -1,15 +1,31 @@
 from collections import namedtuple
 import logging
-from typing import List, Tuple
+import math
+from typing import Dict, Iterator, List, Tuple
 
 import cv2 as cv
 import numpy as np
-from PIL import Image, ImageOps
 
 from input_image_generator.generator import InputImageGenerator
 
 TestImageTuple = namedtuple("TestImageTuple", ["input_image", "image"])
 
+# How the rotated images are cropped:
+# - "border": crops crop_border pixels on each side (like the former
+#   ImageOps.crop(border=1) after the PIL rotation)
+# - "valid": crops to the largest rectangle without the black corners
+# - "none": keeps the whole expanded image
+CROP_POLICIES = ["border", "valid", "none"]
+
+# right angles are rotated exactly (no interpolation)
+RIGHT_ANGLE_ROTATIONS = {
+    90: cv.ROTATE_90_COUNTERCLOCKWISE,
+    180: cv.ROTATE_180,
+    270: cv.ROTATE_90_CLOCKWISE,
+}
+
+Rotation = namedtuple("Rotation", ["angle", "matrix", "size", "crop"])
+
 
 class TestDataPipeline:
     """
@@ -23,18 +39,38 @@ class TestDataPipeline:
         self,
         resize: Tuple[int, int] = (128, 128),
         rotation_augmentation_degree: int = None,
+        crop_policy: str = "border",
+        crop_border: int = 1,
+        interpolation: int = cv.INTER_NEAREST,
     ):
+        """
+        param resize: the size of the generated images
+        param rotation_augmentation_degree: rotation step (in degrees) - the
+            image is rotated by every multiple of it in (0, 360)
+        param crop_policy: how rotated images are cropped (see CROP_POLICIES)
+        param crop_border: pixels cropped on each side by the "border" policy
+        param interpolation: the cv2 interpolation of the non right angles
+        """
+        if crop_policy not in CROP_POLICIES:
+            raise ValueError(f"Unknown crop policy: {crop_policy}")
         self._rotation_augmentation_degree = rotation_augmentation_degree
         self._input_image_generator = InputImageGenerator()
         self._resize = resize
+        self._crop_policy = crop_policy
+        self._crop_border = crop_border
+        self._interpolation = interpolation
+        self._angles = rotation_angles(rotation_augmentation_degree)
+        # rotation matrices per image shape - patches mostly share one shape
+        self._rotations: Dict[Tuple[int, int], List[Rotation]] = {}
 
     @property
     def total_images_per_test_image(self) -> int:
         """
         Returns the total number of images per test image.
-        :return: the total number of images per test image
+        :return: the total number of images per test image (the original
+            image plus one per distinct non-identity rotation)
         """
-        return 360 // self._rotation_augmentation_degree
+        return 1 + len(self._angles)
 
     def generate_test_image(self, image: np.ndarray) -> List[TestImageTuple]:
         """
@@ -43,49 +79,158 @@ class TestDataPipeline:
         :param image: the image
         :return: the input image
         """
+        return list(self.iter_test_images(image))
+
+    def iter_test_images(self, image: np.ndarray) -> Iterator[TestImageTuple]:
+        """
+        Same as generate_test_image, but generates the images one at a time.
+        :param image: the image
+        """
         logging.debug("Generating input images...")
         logging.debug(
             "generating %d images per test image", self.total_images_per_test_image
         )
-        images: List[TestImageTuple] = []
-        for img in self._get_all_rotated_images(image):
+        for img in self._iter_rotated_images(image):
             input_image = cv.resize(
                 self._input_image_generator.generate_input_image(img), self._resize
             )
             img = cv.resize(img, self._resize)
-            images.append(
-                TestImageTuple(
-                    input_image=input_image,
-                    image=img,
-                )
+            yield TestImageTuple(
+                input_image=input_image,
+                image=img,
             )
-        return images
 
-    def _get_all_rotated_images(self, image: np.ndarray) -> List[np.ndarray]:
+    def _iter_rotated_images(self, image: np.ndarray) -> Iterator[np.ndarray]:
         """
-        Returns a list of all rotated images.
+        Iterates over all rotated images - the original image first.
         :param image: the image
-        :return: the list of all rotated images
         """
-        images = [image]
-        rows, cols, _ = image.shape
-        if self._rotation_augmentation_degree:
-            for angle in range(0, 360, self._rotation_augmentation_degree):
-                rotated = rotate(image, angle)
-                images.append(rotated)
-        return images
+        yield image
+        for rotation in self._get_rotations(image.shape[:2]):
+            yield rotate(image, rotation, self._interpolation)
+
+    def _get_rotations(self, shape: Tuple[int, int]) -> List[Rotation]:
+        if shape not in self._rotations:
+            self._rotations[shape] = [
+                rotation_for(shape, angle, self._crop_policy, self._crop_border)
+                for angle in self._angles
+            ]
+        return self._rotations[shape]
 
 
-def rotate(image: np.ndarray, angle: int) -> np.ndarray:
+def rotation_angles(degree: int) -> List[int]:
+    """
+    Returns the distinct, non-identity rotation angles of a rotation step.
+    :param degree: the rotation step (None or 0 for no rotation)
+    :return: the angles in (0, 360)
+    """
+    if not degree:
+        return []
+    return sorted({angle % 360 for angle in range(0, 360, degree)} - {0})
+
+
+def rotation_for(
+    shape: Tuple[int, int], angle: int, crop_policy: str = "border", crop_border=1
+) -> Rotation:
+    """
+    Precomputes the rotation of an image shape: the affine matrix (rotating
+    counterclockwise around the center, like PIL, and expanding the output so
+    nothing is cut), the output size and the crop (top, bottom, left, right).
+    :param shape: the (height, width) of the image
+    :param angle: the angle in degrees
+    :param crop_policy: one of CROP_POLICIES
+    :param crop_border: pixels cropped on each side by the "border" policy
     """
-    Rotates an image by a certain degree.
+    height, width = shape
+    radians = math.radians(angle)
+    if angle in (90, 270):
+        out_width, out_height = height, width
+    elif angle == 180:
+        out_width, out_height = width, height
+    else:
+        out_width, out_height = expanded_size(width, height, radians)
+    matrix = cv.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), angle, 1.0)
+    matrix[0, 2] += (out_width - width) / 2
+    matrix[1, 2] += (out_height - height) / 2
+
+    if crop_policy == "border":
+        crop = (crop_border, crop_border, crop_border, crop_border)
+    elif crop_policy == "valid" and angle % 90 == 0:
+        # right angles leave no black corners
+        crop = (0, 0, 0, 0)
+    elif crop_policy == "valid":
+        valid_width, valid_height = largest_rotated_rect(width, height, radians)
+        crop_x = int(math.ceil((out_width - valid_width) / 2))
+        crop_y = int(math.ceil((out_height - valid_height) / 2))
+        crop = (crop_y, crop_y, crop_x, crop_x)
+    else:
+        crop = (0, 0, 0, 0)
+    return Rotation(angle=angle, matrix=matrix, size=(out_width, out_height), crop=crop)
+
+
+def expanded_size(width: int, height: int, radians: float) -> Tuple[int, int]:
+    """
+    Returns the (width, height) of a width x height image rotated by radians
+    around its center and expanded like PIL's expand=True: the extents of the
+    rotated corners, in the pixel grid of the image, rounded outwards.
+    """
+    # rounded like the PIL matrix, so that e.g. cos(90) is exactly 0
+    cos, sin = round(math.cos(radians), 15), round(math.sin(radians), 15)
+    xs, ys = [], []
+    for x, y in ((0, 0), (width, 0), (width, height), (0, height)):
+        x, y = x - width / 2, y - height / 2
+        xs.append(cos * x + sin * y + width / 2)
+        ys.append(-sin * x + cos * y + height / 2)
+    return (
+        math.ceil(max(xs)) - math.floor(min(xs)),
+        math.ceil(max(ys)) - math.floor(min(ys)),
+    )
+
+
+def largest_rotated_rect(width: int, height: int, radians: float) -> Tuple[int, int]:
+    """
+    Returns the (width, height) of the largest axis-aligned rectangle inside a
+    width x height rectangle rotated by radians (i.e. without black corners).
+    """
+    sin, cos = abs(math.sin(radians)), abs(math.cos(radians))
+    long_side, short_side = max(width, height), min(width, height)
+    if short_side <= 2.0 * sin * cos * long_side or abs(sin - cos) < 1e-10:
+        # the rectangle touches the long sides of the rotated image only
+        x = 0.5 * short_side
+        if width >= height:
+            valid_width, valid_height = x / sin, x / cos
+        else:
+            valid_width, valid_height = x / cos, x / sin
+    else:
+        cos_2a = cos * cos - sin * sin
+        valid_width = (width * cos - height * sin) / cos_2a
+        valid_height = (height * cos - width * sin) / cos_2a
+    # the tolerance keeps e.g. 397.99999999999994 from losing a pixel
+    return int(valid_width + 1e-6), int(valid_height + 1e-6)
+
+
+def rotate(
+    image: np.ndarray, rotation: Rotation, interpolation: int = cv.INTER_NEAREST
+) -> np.ndarray:
+    """
+    Rotates an image by a precomputed rotation (see rotation_for).
     :param image: the image
-    :param angle: the angle
+    :param rotation: the rotation
+    :param interpolation: the cv2 interpolation of the non right angles
     :return: the rotated image
     """
-    pil_image = Image.fromarray(image)
-    rotated_image = pil_image.rotate(angle, expand=True)
+    if rotation.angle in RIGHT_ANGLE_ROTATIONS:
+        rotated_image = cv.rotate(image, RIGHT_ANGLE_ROTATIONS[rotation.angle])
+    else:
+        rotated_image = cv.warpAffine(
+            image,
+            rotation.matrix,
+            rotation.size,
+            flags=interpolation,
+            borderMode=cv.BORDER_CONSTANT,
+            borderValue=0,
+        )
     # get rid of black borders
-
-    rotated_image = ImageOps.crop(rotated_image, border=1)
-    return np.array(rotated_image)
+    top, bottom, left, right = rotation.crop
+    out_width, out_height = rotation.size
+    return rotated_image[top : out_height - bottom, left : out_width - right]
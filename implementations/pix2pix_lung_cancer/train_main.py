@@ -2,8 +2,16 @@
 import logging
 import argparse
 from argparse import Namespace
-from gan_network.pix2pix_data_pipeline import get_test_dataset, get_train_dataset
-from gan_network.gan_model import GanModel
+from gan_network.pix2pix_data_pipeline import (
+    AUGMENTATIONS,
+    CACHE_IN_MEMORY,
+    get_streaming_train_dataset,
+    get_test_dataset,
+    get_train_dataset,
+    get_train_dataset_fn,
+)
+from gan_network.distribute import DISTRIBUTIONS, check_batch_size, create_strategy
+from gan_network.gan_model import PRECISIONS, GanModel
 
 
 def parse_args() -> Namespace:
@@ -23,6 +31,54 @@ def parse_args() -> Namespace:
         default="./data/saved_input_data",
         help="input data directory (previously generated, rotated images)",
     )
+    parset.add_argument(
+        "--train_patches_dir",
+        type=str,
+        default=None,
+        help="patches directory (patch store or png patches) - if set, the "
+        "train pairs are generated on the fly instead of read from train_data_dir",
+    )
+    parset.add_argument(
+        "--rotate_images",
+        type=int,
+        default=90,
+        help="rotation step (in degrees) of the on the fly generated train pairs",
+    )
+    parset.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="cache of the decoded train pairs: 'memory' or a local directory "
+        "(default: no cache, every epoch decodes the pairs again). Cached pairs "
+        "keep one random order, only reshuffled by the shuffle buffer",
+    )
+    parset.add_argument(
+        "--cache_memory_budget_mb",
+        type=int,
+        default=4096,
+        help="the in memory cache is skipped when the train pairs do not fit in it",
+    )
+    parset.add_argument(
+        "--augmentation",
+        type=str,
+        choices=AUGMENTATIONS,
+        default="batch",
+        help="random jittering of whole batches (after batching) or of every "
+        "train pair on its own",
+    )
+    parset.add_argument(
+        "--image_size",
+        type=int,
+        default=256,
+        help="training resolution (square) - the generator depth and the train "
+        "and test pair sizes derive from it (e.g. 128, as in the paper)",
+    )
+    parset.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="seed of the train data shuffling and augmentation",
+    )
     parset.add_argument(
         "--test_data_dir",
         type=str,
@@ -41,17 +97,121 @@ def parse_args() -> Namespace:
         default="./data/checkpoint",
         help="checkpoint dir - to save the model",
     )
+    parset.add_argument(
+        "--resume",
+        action="store_true",
+        help="resume training from the latest checkpoint of checkpoint_dir",
+    )
+    parset.add_argument(
+        "--max_to_keep",
+        type=int,
+        default=5,
+        help="number of checkpoints kept",
+    )
+    parset.add_argument(
+        "--save_every_steps",
+        type=int,
+        default=5000,
+        help="save a checkpoint every save_every_steps steps",
+    )
+    parset.add_argument(
+        "--save_every_minutes",
+        type=float,
+        default=None,
+        help="also save a checkpoint when the last one is older than this",
+    )
+    parset.add_argument(
+        "--no_iterator_checkpoint",
+        action="store_true",
+        help="do not save the train iterator in the checkpoints (a resumed "
+        "training then restarts the data order). Saving it makes the "
+        "checkpoints synchronous, and holds the shuffle buffer - about 150 MB of "
+        "256x256 pairs - in each of the max_to_keep checkpoints, and the whole "
+        "cache with --cache memory (so it is never saved then)",
+    )
+    parset.add_argument(
+        "--sync_checkpoint",
+        action="store_true",
+        help="write the checkpoints in the training loop (not in the background). "
+        "They are always synchronous when the train iterator is saved (see "
+        "--no_iterator_checkpoint): the background ones leave it out, and --resume "
+        "would then restart the data order",
+    )
+    parset.add_argument(
+        "--summary_every_steps",
+        type=int,
+        default=100,
+        help="write the mean losses and steps/sec every summary_every_steps steps",
+    )
+    parset.add_argument(
+        "--steps_per_execution",
+        type=int,
+        default=1,
+        help="number of train steps run by a single compiled call",
+    )
+    parset.add_argument(
+        "--jit",
+        action="store_true",
+        help="compile the train step and the generator with XLA",
+    )
+    parset.add_argument(
+        "--precision",
+        type=str,
+        choices=PRECISIONS,
+        default="float32",
+        help="compute dtype policy of the generator and discriminator",
+    )
+    parset.add_argument(
+        "--distribution",
+        type=str,
+        choices=DISTRIBUTIONS,
+        default="none",
+        help="data parallel training across the logical CPU devices ('mirrored') "
+        "or across the worker processes of TF_CONFIG ('multi_worker')",
+    )
+    parset.add_argument(
+        "--cpu_devices",
+        type=int,
+        default=1,
+        help="number of logical devices the CPU is split in (one replica each "
+        "with the 'mirrored' distribution)",
+    )
+    parset.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="global batch size - split between the replicas",
+    )
+    parset.add_argument(
+        "--accumulation_steps",
+        type=int,
+        default=1,
+        help="number of micro-batches the gradients of a (replica) batch are "
+        "accumulated over before an update - bigger batches in the same memory",
+    )
+    parset.add_argument(
+        "--recompute",
+        action="store_true",
+        help="recompute the generator activations in the backward pass instead "
+        "of keeping them (less memory per sample, slower steps)",
+    )
     parset.add_argument(
         "--generated_images_dir",
         type=str,
         default="./data/generated_images",
         help="generated images dir - to save the generated images while training",
     )
+    parset.add_argument(
+        "--sample_images",
+        type=int,
+        default=1,
+        help="number of test examples of the images generated every 1000 steps",
+    )
     parset.add_argument(
         "--steps",
         type=int,
         default=40000,
-        help="number of steps",
+        help="total number of steps (including the resumed ones)",
     )
     parset.add_argument(
         "--optimizer",
@@ -66,7 +226,10 @@ def parse_args() -> Namespace:
         help="learning rate",
     )
 
-    return parset.parse_args()
+    args = parset.parse_args()
+    if args.sample_images < 1:
+        parset.error("--sample_images must be at least 1")
+    return args
 
 
 def main():
@@ -74,18 +237,84 @@ def main():
     logging.info("Parsing args...")
     args = parse_args()
     logging.info("Processing with arguments: %s", str(args))
+    # before anything else initializes the devices
+    strategy = create_strategy(args.distribution, args.cpu_devices)
+    check_batch_size(strategy, args.batch_size, args.accumulation_steps)
+    distributed = args.distribution != "none"
+    image_size = (args.image_size, args.image_size)
     logging.info("Getting train data...")
-    train_dataset = get_train_dataset(args.train_data_dir)
+    if args.train_patches_dir is not None:
+        train_dataset = get_streaming_train_dataset(
+            args.train_patches_dir,
+            args.rotate_images,
+            batch_size=args.batch_size,
+            cache=args.cache,
+            cache_memory_budget_mb=args.cache_memory_budget_mb,
+            augmentation=args.augmentation,
+            seed=args.seed,
+            image_size=image_size,
+        )
+    elif distributed:
+        # every worker reads its own shard of the records
+        train_dataset = get_train_dataset_fn(
+            args.train_data_dir,
+            batch_size=args.batch_size,
+            cache=args.cache,
+            cache_memory_budget_mb=args.cache_memory_budget_mb,
+            augmentation=args.augmentation,
+            seed=args.seed,
+            image_size=image_size,
+        )
+    else:
+        train_dataset = get_train_dataset(
+            args.train_data_dir,
+            batch_size=args.batch_size,
+            cache=args.cache,
+            cache_memory_budget_mb=args.cache_memory_budget_mb,
+            augmentation=args.augmentation,
+            seed=args.seed,
+            image_size=image_size,
+        )
     logging.info("Getting test data...")
-    test_dataset = get_test_dataset(args.test_data_dir)
+    test_dataset = get_test_dataset(args.test_data_dir, image_size=image_size)
     logging.info("Initializing model...")
     model = GanModel(
         checkpoint_dir=args.checkpoint_dir,
         save_image_dir=args.generated_images_dir,
         log_dir=args.log_dir,
+        input_size=image_size,
+        load_checkpoint=args.resume,
+        max_to_keep=args.max_to_keep,
+        async_checkpoint=not args.sync_checkpoint,
+        jit_compile=args.jit,
+        precision=args.precision,
+        strategy=strategy if distributed else None,
+        accumulation_steps=args.accumulation_steps,
+        recompute=args.recompute,
     )
+    # the streaming pairs come from a Python generator, it cannot be saved
+    save_iterator = args.train_patches_dir is None and not args.no_iterator_checkpoint
+    if save_iterator and args.cache == CACHE_IN_MEMORY:
+        logging.warning(
+            "Not saving the train iterator: it would copy the in memory cache "
+            "(up to %d MB) into every checkpoint",
+            args.cache_memory_budget_mb,
+        )
+        save_iterator = False
     logging.info("Starting training (fitting)...")
-    model.fit(train_dataset, test_dataset, steps=args.steps)
+    model.fit(
+        train_dataset,
+        test_dataset,
+        steps=args.steps,
+        save_iterator=save_iterator,
+        save_every_steps=args.save_every_steps,
+        save_every_secs=(
+            args.save_every_minutes * 60 if args.save_every_minutes else None
+        ),
+        summary_every_steps=args.summary_every_steps,
+        steps_per_execution=args.steps_per_execution,
+        num_examples=args.sample_images,
+    )
 
 
 if __name__ == "__main__":